@@ -0,0 +1,72 @@
+# coding=utf-8
+# Compare text rendering through FreeType (ImageDraw.text/textsize) with the glyph atlas.
+#
+#   python benchmarks/bench_glyphs.py [font size]
+from __future__ import absolute_import, print_function
+
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from headless import FONT
+from octoprint_OctOLED.glyphs import GlyphAtlas
+
+TEXT = "SSD1306 ORGANIC LED DISPLAY. ETA 01:23:45 benchy_0.2mm_PLA.gcode 210/60C"
+DURATION = 2.0
+
+
+def run(name, fn, glyphs_per_call):
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        fn()
+        calls += 1
+    elapsed = time.perf_counter() - start
+    rate = calls * glyphs_per_call / elapsed
+    print("{0:<28} {1:>12,.0f} glyphs/sec".format(name, rate))
+    return rate
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 14
+    font = ImageFont.truetype(FONT, size)
+    image = Image.new("1", (128, 64))
+    draw = ImageDraw.Draw(image)
+
+    start = time.perf_counter()
+    atlas = GlyphAtlas(font)
+    print("Atlas build: {0:.1f} ms ({1}pt)".format((time.perf_counter() - start) * 1000, size))
+
+    # show_text: measure + draw the whole string
+    def freetype_string():
+        draw.textsize(TEXT, font=font)
+        draw.text((0, 0), TEXT, font=font, fill=255)
+
+    def atlas_string():
+        atlas.getsize(TEXT)
+        atlas.draw_text(draw, (0, 0), TEXT, fill=255)
+
+    # demo scroller: measure + draw one character at a time
+    def freetype_chars():
+        x = 0
+        for c in TEXT:
+            draw.text((x, 0), c, font=font, fill=255)
+            x += draw.textsize(c, font=font)[0]
+
+    def atlas_chars():
+        x = 0
+        for c in TEXT:
+            x += atlas.draw_char(draw, (x, 0), c, fill=255)
+
+    n = len(TEXT)
+    before = run("FreeType, whole string", freetype_string, n)
+    after = run("Atlas, whole string", atlas_string, n)
+    print("  speedup: {0:.1f}x".format(after / before))
+    before = run("FreeType, per character", freetype_chars, n)
+    after = run("Atlas, per character", atlas_chars, n)
+    print("  speedup: {0:.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# coding=utf-8
+# Time to auto-fit status strings to the display: the first layout of each string (size search with
+# FreeType measurements) and every later one (layout cache).
+#
+#   python benchmarks/bench_layout.py [--size 128x32] [--max-font 24] [--rounds 1000]
+from __future__ import absolute_import, print_function
+
+import argparse
+import time
+
+from PIL import ImageFont
+
+from headless import FONT
+from octoprint_OctOLED.layout import TextFitter
+
+TEXTS = [
+    "Printing benchy_0.2mm_PLA.gcode",
+    "Heating 185/210C",
+    "Z 12.40 - layer 62 of 240",
+    "ETA 1h23m",
+    "Paused: filament runout, please load new filament and resume"
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark auto-fit text layout")
+    parser.add_argument("--size", default="128x32")
+    parser.add_argument("--max-font", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=1000)
+    args = parser.parse_args()
+    width, height = [int(v) for v in args.size.lower().split("x")]
+
+    fitter = TextFitter(lambda size: ImageFont.truetype(FONT, size))
+    start = time.perf_counter()
+    for text in TEXTS:
+        fitter.fit(text, width, height, args.max_font)
+    first = (time.perf_counter() - start) / len(TEXTS)
+
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for text in TEXTS:
+            fitter.fit(text, width, height, args.max_font)
+    cached = (time.perf_counter() - start) / (args.rounds * len(TEXTS))
+
+    for text in TEXTS:
+        layout = fitter.fit(text, width, height, args.max_font)
+        print("{0:>3}pt {1} line(s){2}  {3}".format(layout.size, len(layout.lines), "" if layout.fits else " (clipped)", text))
+    print("first layout:  {0:8.1f} us".format(first * 1e6))
+    print("cached layout: {0:8.2f} us".format(cached * 1e6))
+    print("FreeType measurements: {0}".format(fitter.stats()["measurements"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# coding=utf-8
+# Compare packing a PIL image into the SSD1306 page layout with the driver's image() against
+# framebuffer.pack_image(). Besides Pillow this needs adafruit-circuitpython-framebuf (installed with the
+# SSD1306 driver, or `pip install adafruit-circuitpython-framebuf`).
+#
+#   python benchmarks/bench_packing.py
+from __future__ import absolute_import, print_function
+
+import random
+import time
+
+from PIL import Image
+
+import adafruit_framebuf
+
+import headless  # noqa: F401
+from octoprint_OctOLED.framebuffer import pack_image
+
+DURATION = 1.0
+GEOMETRIES = [(128, 32), (128, 64)]
+
+
+def run(fn):
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        fn()
+        calls += 1
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    random.seed(0)
+    for width, height in GEOMETRIES:
+        image = Image.new("1", (width, height))
+        pixels = image.load()
+        for _ in range(width * height // 3):
+            pixels[random.randrange(width), random.randrange(height)] = 255
+        for rotation in (0, 2):
+            # Same buffer layout as SSD1306_I2C: one control byte followed by the pages
+            buffer = bytearray(width * height // 8 + 1)
+            driver = adafruit_framebuf.FrameBuffer(memoryview(buffer)[1:], width, height, adafruit_framebuf.MVLSB)
+            driver.rotation = rotation
+            packed = bytearray(len(buffer))
+
+            pack_image(image, packed, width, height, rotation)
+            driver.image(image)
+            assert packed[1:] == buffer[1:], "pack_image output differs from the driver"
+
+            before = run(lambda: driver.image(image))
+            after = run(lambda: pack_image(image, packed, width, height, rotation))
+            print("{0}x{1} rotation {2}: driver {3:8.3f} ms  pack_image {4:6.3f} ms  ({5:.0f}x)".format(
+                width, height, rotation * 90, before * 1000, after * 1000, before / after))
+
+
+if __name__ == "__main__":
+    main()
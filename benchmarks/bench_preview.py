@@ -0,0 +1,68 @@
+# coding=utf-8
+# Bytes/sec of the live preview stream while the demo animation runs, compared to sending every
+# preview frame in full.
+#
+#   python benchmarks/bench_preview.py [--size 128x32] [--fps 10] [--preview-rate 5] [--seconds 30]
+from __future__ import absolute_import, print_function
+
+import argparse
+import base64
+import json
+
+from PIL import Image, ImageFont
+
+from headless import FONT
+from octoprint_OctOLED.framebuffer import pack_image
+from octoprint_OctOLED.glyphs import GlyphAtlas
+from octoprint_OctOLED.marquee import Marquee, sine_table
+from octoprint_OctOLED.preview import PreviewEncoder
+
+DEMO_TEXT = "SSD1306 ORGANIC LED DISPLAY. THIS IS AN OLD SCHOOL DEMO SCROLLER!! GREETZ TO: LADYADA & THE ADAFRUIT CREW"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the preview stream bandwidth during the demo animation")
+    parser.add_argument("--size", default="128x32")
+    parser.add_argument("--fps", type=float, default=10, help="demo animation frame rate")
+    parser.add_argument("--preview-rate", type=float, default=5)
+    parser.add_argument("--seconds", type=float, default=30, help="simulated animation time")
+    args = parser.parse_args()
+    width, height = [int(v) for v in args.size.lower().split("x")]
+
+    atlas = GlyphAtlas(ImageFont.truetype(FONT, 14))
+    marquee = Marquee(atlas, DEMO_TEXT, width, height, gap=width, y=height / 2 - 4, wave=sine_table(width, width / 4))
+    image = Image.new("1", (width, height))
+    buffer = bytearray(width * height // 8 + 1)
+    encoder = PreviewEncoder()
+
+    # Same throttling as PreviewStream: the latest frame at most preview_rate times per second
+    frames = int(args.seconds * args.fps)
+    interval = 1.0 / args.preview_rate
+    next_send = 0.0
+    delta_bytes = 0
+    full_bytes = 0
+    messages = 0
+    pos = -width
+    for frame in range(frames):
+        marquee.render(image, pos)
+        pos += 2
+        now = frame / args.fps
+        if now + 1e-9 < next_send:
+            continue
+        next_send = now + interval
+        pack_image(image, buffer, width, height)
+        message = encoder.encode(width, height, buffer[1:])
+        if message is not None:
+            messages += 1
+            delta_bytes += len(json.dumps(message))
+        full = dict(type="frame", width=width, height=height, data=base64.b64encode(bytes(buffer[1:])).decode("ascii"))
+        full_bytes += len(json.dumps(full))
+
+    print("{0}x{1} demo at {2:g} fps, preview at {3:g} fps, {4:g} s:".format(width, height, args.fps, args.preview_rate, args.seconds))
+    print("  full frames:  {0:8.0f} bytes/sec".format(full_bytes / args.seconds))
+    print("  page diffs:   {0:8.0f} bytes/sec  ({1} messages, {2:.0%} of full frames)".format(
+        delta_bytes / args.seconds, messages, delta_bytes / float(full_bytes)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# coding=utf-8
+# Frames/sec, CPU time and bus bytes per frame of OctOLED's rendering paths on a virtual SSD1306.
+# Needs nothing but Pillow; the virtual bus sleeps for as long as each transfer would take on real
+# hardware at --bus-speed (--no-sleep only counts it, which measures the CPU bound).
+#
+#   python benchmarks/bench_render.py [--size 128x32] [--bus-speed 400000] [--duration 2] [--no-sleep]
+#                                     [--json] [scenario ...]
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import time
+
+from PIL import ImageFont
+
+from headless import FONT
+from octoprint_OctOLED.backends import VirtualBackend
+from octoprint_OctOLED.displays import BusManager, Display
+from octoprint_OctOLED.glyphs import GlyphCache
+from octoprint_OctOLED.marquee import Marquee, sine_table
+from octoprint_OctOLED.widgets import Compositor
+
+FONT_SIZE = 14
+DEMO_TEXT = "SSD1306 ORGANIC LED DISPLAY. THIS IS AN OLD SCHOOL DEMO SCROLLER!! GREETZ TO: LADYADA & THE ADAFRUIT CREW"
+STATUS_TEXTS = ["Printing 42%", "Z 12.40", "210/60C", "ETA 1h23m"]
+WIDGETS = [
+    dict(type="text", box=[0, 0, 128, 11], format="{file}", font_size=9),
+    dict(type="progress", box=[0, 13, 96, 7]),
+    dict(type="text", box=[98, 11, 30, 11], format="{progress}%", font_size=9, align="right"),
+    dict(type="text", box=[0, 22, 64, 10], format="{tool0}/{bed}C", font_size=9),
+    dict(type="text", box=[64, 22, 64, 10], format="{eta}", font_size=9, align="right")
+]
+
+
+def load_atlas(cache, size):
+    return cache.get("Noto_Sans/NotoSans-Regular", size, lambda: ImageFont.truetype(FONT, size))
+
+
+##~~ Scenarios
+# Each one sets up its state and returns a function that draws the next frame into display.image
+
+def show_text(display, atlas, cache):
+    frame = [0]
+
+    def draw():
+        display.draw_centered_text(atlas, STATUS_TEXTS[frame[0] % len(STATUS_TEXTS)])
+        frame[0] += 1
+    return draw
+
+
+def demo(display, atlas, cache):
+    width, height = display.oled.width, display.oled.height
+    marquee = Marquee(atlas, DEMO_TEXT, width, height, gap=width, y=height / 2 - 4, wave=sine_table(width, width / 4))
+    pos = [-width]
+
+    def draw():
+        marquee.render(display.image, pos[0])
+        pos[0] += 2
+    return draw
+
+
+def marquee(display, atlas, cache):
+    scroller = Marquee(atlas, DEMO_TEXT, display.oled.width, display.oled.height)
+    pos = [0]
+
+    def draw():
+        scroller.render(display.image, pos[0])
+        pos[0] += 2
+    return draw
+
+
+# Status screen during a print: one value changes per frame, so only small parts of the panel do
+def widgets(display, atlas, cache):
+    compositor = Compositor.from_settings(WIDGETS, lambda size: atlas if size is None else load_atlas(cache, int(size)))
+    state = dict(file="benchy_0.2mm_PLA.gcode", progress="0", tool0="210", bed="60", eta="1h23m")
+    frame = [0]
+
+    def draw():
+        frame[0] += 1
+        if frame[0] % 2:
+            state["progress"] = str(frame[0] // 2 % 101)
+        else:
+            state["tool0"] = str(205 + frame[0] % 10)
+        compositor.update(state)
+        compositor.compose(display.image)
+    return draw
+
+
+SCENARIOS = dict(show_text=show_text, demo=demo, marquee=marquee, widgets=widgets)
+
+
+def bench(name, args, width, height):
+    backend = VirtualBackend(simulate_timing=not args.no_sleep)
+    buses = BusManager(lambda bus_id: backend.open_bus(bus_id, args.bus_speed))
+    display = Display(name, buses.get(None), lambda i2c: backend.create_driver(i2c, width, height, 0x3C))
+    bus = display.oled.i2c_device.i2c
+    cache = GlyphCache()
+    draw = SCENARIOS[name](display, load_atlas(cache, FONT_SIZE), cache)
+
+    # Warm up (atlases, first full frame), then measure from a clean slate
+    for _ in range(3):
+        draw()
+        display.pack()
+        display.flush()
+    bus_time, bus_bytes = bus.bus_time, bus.bytes
+
+    frames = 0
+    sent = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    while time.perf_counter() - start < args.duration:
+        draw()
+        display.pack()
+        sent += display.flush()
+        frames += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    # The panel has to show exactly what was drawn, otherwise the numbers mean nothing
+    assert display.oled.frame() == bytes(display.oled.buffer[1:]), name + ": panel differs from the framebuffer"
+    return dict(
+        scenario=name,
+        size="{0}x{1}".format(width, height),
+        bus_speed=args.bus_speed,
+        frames=frames,
+        fps=frames / elapsed,
+        cpu_ms_per_frame=cpu / frames * 1000,
+        bytes_per_frame=sent / float(frames),
+        bus_bytes_per_frame=(bus.bytes - bus_bytes) / float(frames),
+        bus_ms_per_frame=(bus.bus_time - bus_time) / frames * 1000
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OctOLED rendering on a virtual SSD1306")
+    parser.add_argument("scenarios", nargs="*", help=", ".join(sorted(SCENARIOS.keys())) + " (default: all)")
+    parser.add_argument("--size", default="128x32")
+    parser.add_argument("--bus-speed", type=int, default=400000)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--no-sleep", action="store_true", help="don't wait for simulated bus transfers")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    width, height = [int(v) for v in args.size.lower().split("x")]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: " + name)
+
+    results = []
+    for name in args.scenarios or sorted(SCENARIOS.keys()):
+        result = bench(name, args, width, height)
+        results.append(result)
+        if not args.json:
+            print("{scenario:<10} {size} @ {bus_speed} Hz: {fps:8.1f} fps  {cpu_ms_per_frame:6.2f} ms CPU/frame  "
+                  "{bytes_per_frame:7.1f} bytes/frame  {bus_ms_per_frame:6.2f} ms bus/frame".format(**result))
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
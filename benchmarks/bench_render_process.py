@@ -0,0 +1,147 @@
+# coding=utf-8
+# CPU used by OctOLED in OctoPrint's process, rendering in-process compared to the render process, and
+# how late a stand-in for OctoPrint's serial thread (wakes up every 2 ms and does a little work) runs
+# meanwhile. The plugin runs as in OctoPrint on a virtual SSD1306: status screen updates at --rate per
+# second, or text scrolling in software at --fps. Needs OctoPrint (run it in OctoPrint's virtualenv) and
+# Linux (the worker's CPU time comes from /proc).
+#
+#   python benchmarks/bench_render_process.py [--duration 5] [--rate 10] [--scroll] [--fps 20]
+#                                             [--bus-speed 400000]
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_OctOLED import OctOLEDPlugin  # noqa: E402
+
+SERIAL_INTERVAL = 0.002
+SERIAL_LINE = b"ok T:210.0 /210.0 B:60.0 /60.0 @:127 B@:64\n"
+
+
+# OctoPrint's settings.get([key]) on top of the plugin's defaults
+class Settings(object):
+    def __init__(self, values):
+        self._values = values
+
+    def get(self, path):
+        return self._values[path[0]]
+
+    def set(self, path, value):
+        self._values[path[0]] = value
+
+
+def create_plugin(args, data_folder, render_process):
+    plugin = OctOLEDPlugin()
+    values = plugin.get_settings_defaults()
+    values.update(
+        display_backend="virtual",
+        display_mode="text" if args.scroll else "widgets",
+        display_text="Printing benchy_0.2mm_PLA.gcode, layer 62 of 240",
+        scroll_mode="always" if args.scroll else "off",
+        scroll_hardware=False,
+        scroll_fps=args.fps,
+        max_refresh_rate=args.rate,
+        adaptive_refresh=False,
+        i2c_frequency=args.bus_speed,
+        render_process=render_process
+    )
+    plugin._settings = Settings(values)
+    plugin._logger = logging.getLogger("octoprint.plugins.OctOLED")
+    plugin._identifier = "OctOLED"
+    plugin._data_folder = data_folder
+    plugin._plugin_manager = types.SimpleNamespace(send_plugin_message=lambda *args: None)
+    return plugin
+
+
+# Seconds of CPU used by a process so far
+def process_cpu(pid):
+    with open("/proc/" + str(pid) + "/stat") as stat:
+        # Fields after the command name, which may contain spaces
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+# Stand-in for the serial thread: how late it wakes up is how long it waited for the GIL (and the CPU).
+# Its own CPU time is put in cpu[0].
+def serial_thread(stop, delays, cpu):
+    cpu_start = time.thread_time()
+    deadline = time.perf_counter()
+    while not stop.is_set():
+        deadline += SERIAL_INTERVAL
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+        now = time.perf_counter()
+        delays.append(max(0.0, now - deadline))
+        deadline = max(deadline, now)
+        sum(SERIAL_LINE)
+    cpu[0] = time.thread_time() - cpu_start
+
+
+def bench(args, render_process):
+    data_folder = tempfile.mkdtemp(prefix="octoled-bench-")
+    plugin = create_plugin(args, data_folder, render_process)
+    plugin.on_after_startup()
+    while plugin._init_state == "pending":
+        time.sleep(0.05)
+    if plugin._init_state != "ready":
+        raise RuntimeError("Plugin failed to start: " + plugin._init_state)
+    # Let startup (the first frames, the worker's imports) settle
+    time.sleep(1.0)
+
+    stop = threading.Event()
+    delays = []
+    serial_cpu = [0.0]
+    serial = threading.Thread(target=serial_thread, args=(stop, delays, serial_cpu))
+    worker = plugin._renderer._process.pid if render_process else None
+    worker_start = process_cpu(worker) if worker is not None else 0.0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    serial.start()
+    updates = 0
+    while time.perf_counter() - start < args.duration:
+        updates += 1
+        plugin.queue_update("progress", str(updates % 101))
+        plugin.queue_update("tool0", str(205 + updates % 10))
+        time.sleep(1.0 / args.rate)
+    stop.set()
+    serial.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start - serial_cpu[0]
+    worker_cpu = process_cpu(worker) - worker_start if worker is not None else 0.0
+    plugin.on_shutdown()
+
+    delays.sort()
+    return dict(
+        mode="render process" if render_process else "in-process",
+        main_cpu=cpu / elapsed * 100,
+        worker_cpu=worker_cpu / elapsed * 100,
+        serial_p99_ms=delays[int(len(delays) * 0.99)] * 1000,
+        serial_max_ms=delays[-1] * 1000
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OctoPrint's CPU use with and without the render process")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--rate", type=float, default=10.0, help="status updates per second")
+    parser.add_argument("--scroll", action="store_true", help="scroll text in software instead of the status screen")
+    parser.add_argument("--fps", type=int, default=20, help="scroll frame rate")
+    parser.add_argument("--bus-speed", type=int, default=400000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    for render_process in (False, True):
+        result = bench(args, render_process)
+        print("{mode:<15} OctOLED in OctoPrint's process {main_cpu:5.1f}% CPU  worker {worker_cpu:5.1f}% CPU  "
+              "serial thread late by {serial_p99_ms:5.2f} ms (p99), {serial_max_ms:6.2f} ms (max)".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+# CPU time per frame of playing an animated GIF by decoding it on the fly (convert, pack, diff) compared
+# to playing its compiled sprite file (copy from the memory map, send the precomputed windows), on a
+# virtual SSD1306 that doesn't wait for the bus. Uses the given GIF/APNG or generates one.
+#
+#   python benchmarks/bench_sprite.py [--size 128x32] [--frames 50] [--loops 20] [source]
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import headless  # noqa: F401
+from octoprint_OctOLED.backends import VirtualBackend
+from octoprint_OctOLED.displays import BusManager, Display
+from octoprint_OctOLED.sprites import Sprite, compile_sprite, load_frames
+
+
+# A ball bouncing across the panel
+def make_gif(path, width, height, count):
+    frames = []
+    for i in range(count):
+        image = Image.new("L", (width, height))
+        x = (i * 4) % (width - 12)
+        y = abs((i * 3) % (2 * (height - 12)) - (height - 12))
+        ImageDraw.Draw(image).ellipse((x, y, x + 11, y + 11), fill=255)
+        frames.append(image)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=40, loop=0)
+
+
+def new_display(width, height):
+    backend = VirtualBackend(simulate_timing=False)
+    buses = BusManager(lambda bus_id: backend.open_bus(bus_id, 400000))
+    return Display("bench", buses.get(None), lambda i2c: backend.create_driver(i2c, width, height, 0x3C))
+
+
+def decode(source, width, height, loops):
+    display = new_display(width, height)
+    start = time.process_time()
+    frames = 0
+    for _ in range(loops):
+        for image, duration in load_frames(source, width, height):
+            display.image.paste(image)
+            display.pack()
+            display.flush()
+            frames += 1
+    return (time.process_time() - start) / frames * 1000, display
+
+
+def play(path, width, height, loops):
+    display = new_display(width, height)
+    sprite = Sprite(path)
+    start = time.process_time()
+    frames = 0
+    previous = None
+    for _ in range(loops):
+        for index in range(len(sprite)):
+            display.write_frame(sprite.frame(index))
+            display.flush(sprite.rects(index), previous)
+            previous = sprite.frame(index)
+            frames += 1
+    return (time.process_time() - start) / frames * 1000, display
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare live GIF decoding to compiled sprite playback")
+    parser.add_argument("source", nargs="?", help="GIF/APNG or directory of images (default: generated)")
+    parser.add_argument("--size", default="128x32")
+    parser.add_argument("--frames", type=int, default=50, help="frames of the generated GIF")
+    parser.add_argument("--loops", type=int, default=20)
+    args = parser.parse_args()
+    width, height = [int(v) for v in args.size.lower().split("x")]
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(workdir, "bounce.gif")
+            make_gif(source, width, height, args.frames)
+        path = os.path.join(workdir, "bounce.sprite")
+        start = time.perf_counter()
+        compile_sprite(source, path, width, height)
+        print("compile:  {0:8.1f} ms, {1} bytes".format((time.perf_counter() - start) * 1000, os.path.getsize(path)))
+
+        decode_ms, decoded = decode(source, width, height, args.loops)
+        play_ms, played = play(path, width, height, args.loops)
+        # Both have to end on the same picture, otherwise the numbers mean nothing
+        assert decoded.oled.frame() == played.oled.frame() == bytes(played.oled.buffer[1:]), "panels differ"
+        print("decode:   {0:8.3f} ms CPU/frame".format(decode_ms))
+        print("sprite:   {0:8.3f} ms CPU/frame ({1:.1f}x)".format(play_ms, decode_ms / play_ms))
+        print("bus:      {0:8.1f} bytes/frame (sprite) vs {1:.1f} (decode)".format(
+            played.differ.stats.as_dict()["bytes_per_frame"], decoded.differ.stats.as_dict()["bytes_per_frame"]))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+# coding=utf-8
+# Makes the octoprint_OctOLED modules importable without OctoPrint or any display hardware: the
+# package is registered without running its __init__ (which defines the OctoPrint plugin), so only
+# the rendering modules themselves and Pillow are needed.
+from __future__ import absolute_import
+
+import os
+import sys
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PACKAGE_DIR = os.path.join(ROOT, "octoprint_OctOLED")
+FONT = os.path.join(PACKAGE_DIR, "fonts", "Noto_Sans", "NotoSans-Regular.ttf")
+
+
+def load_package():
+    if "octoprint_OctOLED" not in sys.modules:
+        package = types.ModuleType("octoprint_OctOLED")
+        package.__path__ = [PACKAGE_DIR]
+        sys.modules["octoprint_OctOLED"] = package
+    return sys.modules["octoprint_OctOLED"]
+
+
+load_package()
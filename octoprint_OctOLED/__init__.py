@@ -1,137 +1,526 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import base64
+import binascii
 import os
-# OLED Display
-import board
-from PIL import Image, ImageDraw, ImageFont
-import adafruit_ssd1306
+from collections import OrderedDict
 
 # API
 import flask
 
 # Animations
-import asyncio
-import math
+import threading
 import time
 
 import octoprint.plugin
+import octoprint.util
+
+from .backends import create_backend
+from .governor import RefreshGovernor
+from .settings import SettingsSnapshot
+from .update_queue import UpdateQueue
+
+# Pillow, asyncio and the hardware libraries are imported on first use (the rendering modules are
+# imported in init_display, which runs on the "OctOLED-init" thread) to keep OctoPrint's startup fast.
+
+# Printer events that change what the status display shows
+PRINT_STATE_EVENTS = {
+    "PrintStarted": "Printing",
+    "PrintPaused": "Paused",
+    "PrintResumed": "Printing",
+    "PrintDone": "Done",
+    "PrintFailed": "Failed",
+    "PrintCancelled": "Cancelled"
+}
+
+# Events that mean someone is looking, they wake a sleeping display
+ACTIVITY_EVENTS = {"ClientOpened", "UserLoggedIn", "Connected", "Disconnected"}
+
+GOVERNOR_SETTINGS = {"max_refresh_rate", "adaptive_refresh", "printing_refresh_rate", "idle_refresh_rate", "sleep_timeout"}
+
+# Settings that only affect what the main display shows
+REDRAW_SETTINGS = {"display_text", "display_mode", "status_format", "auto_fit", "scroll_mode", "scroll_speed", "scroll_fps", "scroll_hardware", "widgets"}
+
+# Settings that need a new driver for the main display
+DRIVER_SETTINGS = {"display_width", "display_height", "display_address", "display_bus"}
+
+# Status keys for heaters reported by the temperature hook, tools are T0, T1, ... -> tool0, tool1, ...
+HEATER_KEYS = {
+    "B": "bed",
+    "C": "chamber"
+}
+
+
+# 5025 -> "1h23m", 65 -> "1m05s"
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return "{0}h{1:02d}m".format(hours, minutes)
+    return "{0}m{1:02d}s".format(minutes, seconds)
+
 
 class OctOLEDPlugin(octoprint.plugin.SettingsPlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.SimpleApiPlugin,
-    octoprint.plugin.EventHandlerPlugin
+    octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.ProgressPlugin
 ):
 
+    def __init__(self):
+        self._oled = None
+        self._frame_differ = None
+        self._render_loop = None
+        self._anim_task = None
+        self._marquee_task = None
+        # What the software marquee shows and how fast, see start_marquee
+        self._marquee = None
+        self._marquee_source = None
+        self._marquee_rate = None
+        # Text, atlas and panel size the controller is scrolling by itself
+        self._hw_scroll_source = None
+        self._glyph_cache = None
+        self._sprite_cache = None
+        self._text_fitter = None
+        self._update_queue = None
+        self._governor = None
+        # Set while the governor lets the display sleep
+        self._asleep = False
+        # Frame rate cap for animations while a print runs, None for none
+        self._render_max_fps = None
+        # Worker process doing the rendering (setting "render_process"), None when rendering in-process
+        self._renderer = None
+        self._compositor = None
+        self._clock_timer = None
+        self._display = None
+        self._backend = None
+        self._buses = None
+        self._extra_displays = []
+        self._extra_display_configs = []
+        # Latest printer state shown by the status display, values are preformatted strings
+        self._printer_state = dict()
+        self._pushed_frames = 0
+        self._preview = None
+        # "pending" until the init thread is done, then "ready", "failed" or "timeout"
+        self._init_state = "pending"
+        self._config = None
+        self._init_lock = threading.Lock()
+        self._init_watchdog = None
+        self._startup_timings = OrderedDict()
+        # Serializes drawing/flushing between OctoPrint's threads and the render thread
+        self._display_lock = threading.RLock()
+
     ##~~ Setup initial display
     # May throw on _oled.show() or show_text()
     def init_display(self, width = -1, height = -1):
+        started = time.monotonic()
+        from .displays import BusManager
+        from .glyphs import GlyphCache
+        from .layout import TextFitter
+        from .sprites import SpriteCache
+        self._glyph_cache = GlyphCache()
+        self._text_fitter = TextFitter(self._font)
+        self._sprite_cache = SpriteCache(os.path.join(self.get_plugin_data_folder(), "sprite_cache"))
+        started = self._startup_phase("imports", started)
+
+        config = self._config
         # TODO: Width and height can be obtained from self._oled once initialized so we probably don't need to store these
-        # TODO: Actually we probably don't need to store any of these that are saved in _settings - or at least just store the ones that are frequently accessed
         # TODO: Expose more configuration options on the plugin settings page
-        self._disp_width = self._settings.get(["display_width"]) if width == -1 else width
-        self._disp_height = self._settings.get(["display_height"]) if height == -1 else height
-        self._disp_rotate_180 = self._settings.get(["rotate_180"])
+        self._disp_width = config.display_width if width == -1 else width
+        self._disp_height = config.display_height if height == -1 else height
+        self._disp_rotate_180 = config.rotate_180
         self._disp_font_face = "Noto_Sans/NotoSans-Regular"
-        self._disp_font_size = int(self._settings.get(["display_font_size"]))
+        self._disp_font_size = config.display_font_size
         self._disp_border = 5
         # TODO: Scan I2C and present a list of options in the settings page
-        self._disp_addr = 0x3C
-        self._current_text = self._settings.get(["display_text"])
-        self._anim_task = None
+        self._disp_addr = config.display_address
+        self._disp_bus = config.display_bus
+        self._current_text = config.display_text
         self._font_dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/fonts') + '/'
-        # Only I2C displays are supported
-        self._i2c = board.I2C()
-        # TODO: Support more display types
-        self._oled = adafruit_ssd1306.SSD1306_I2C(self._disp_width, self._disp_height, self._i2c, addr=self._disp_addr)
-        # reset=oled_reset)
-        if self._disp_rotate_180:
-            self._oled.rotation = 2
-        else:
-            self._oled.rotation = 0
-
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        self._disp_image = Image.new("1", (self._oled.width, self._oled.height))
+        # Only I2C displays are supported. Displays on the same bus share one arbiter.
+        self._backend = create_backend(config.display_backend)
+        self._buses = BusManager(self._open_i2c_bus)
+        self._use_display(self._create_display("main", self._disp_bus, self._disp_addr, self._disp_width, self._disp_height, self._disp_rotate_180, lock=self._display_lock))
+        started = self._startup_phase("display", started)
+        self.load_font()
+        started = self._startup_phase("font", started)
+        self.build_compositor()
 
-        # Get drawing object to draw on image.
-        self._disp_draw = ImageDraw.Draw(self._disp_image)
-        self._logger.info("Loading font: " + self._disp_font_face + ".ttf")
-        self._disp_font = ImageFont.truetype(self._font_dir + self._disp_font_face + ".ttf", int(self._disp_font_size))
-
-        # Clear display.
+        # Clear display. The first frame is sent in full anyway, so only flush the blank frame if
+        # nothing else is going to be drawn.
         self._oled.fill(0)
-        self._oled.show()
+        if not self._enabled:
+            self.flush_display()
         # Draw text
-        self.show_text(self._settings.get(["display_text"]))
+        self.refresh_display()
+        started = self._startup_phase("first frame", started)
+        self.init_extra_displays()
+        self._startup_phase("extra displays", started)
+
+    # Log how long a startup phase took, returns the start time of the next phase
+    def _startup_phase(self, phase, started):
+        now = time.monotonic()
+        self._startup_timings[phase] = (now - started) * 1000
+        self._logger.info("Startup: " + phase + " took {0:.1f} ms".format((now - started) * 1000))
+        return now
+
+    def _open_i2c_bus(self, bus_id):
+        return self._backend.open_bus(bus_id, self._config.i2c_frequency)
+
+    def _transport_options(self):
+        return dict(
+            chunk_size=self._config.i2c_chunk_size,
+            retries=self._config.i2c_retries,
+            backoff=self._config.i2c_retry_backoff_ms / 1000
+        )
+
+    # May throw
+    def _create_display(self, name, bus_id, address, width, height, rotate_180, lock=None):
+        self._logger.info("Setting up display " + name + ": " + str(width) + "x" + str(height) + " at " + hex(address) + " on I2C bus " + str(bus_id if bus_id is not None else "default"))
+        from .displays import Display
+        # TODO: Support more display types
+        return Display(
+            name,
+            self._buses.get(bus_id),
+            lambda i2c: self._backend.create_driver(i2c, width, height, address),
+            rotation=2 if rotate_180 else 0,
+            lock=lock,
+            transport_options=self._transport_options()
+        )
 
+    # Point the main display shortcuts (_oled, _disp_image, ...) at `display`
+    def _use_display(self, display):
+        with self._display_lock:
+            self._display = display
+            self._oled = display.oled
+            self._frame_differ = display.differ
+            self._disp_image = display.image
+            self._disp_draw = display.draw
+
+    # Replace the main display's driver, e.g. for a new size or address. May throw.
     def change_resolution(self, width = -1, height = -1):
-        self._disp_width = self._settings.get(["display_width"]) if width == -1 else width
-        self._disp_height = self._settings.get(["display_height"]) if height == -1 else height
+        self.stop_marquee()
+        self.stop_sprite()
+        config = self._config
+        self._disp_width = config.display_width if width == -1 else width
+        self._disp_height = config.display_height if height == -1 else height
+        self._disp_rotate_180 = config.rotate_180
+        self._disp_addr = config.display_address
+        self._disp_bus = config.display_bus
         self._logger.info("Setting resolution: " + str(self._disp_width) + "x" + str(self._disp_height))
-        self._oled = adafruit_ssd1306.SSD1306_I2C(self._disp_width, self._disp_height, self._i2c, addr=self._disp_addr)
-        if self._disp_rotate_180 != self._settings.get(["rotate_180"]):
-            self._logger.info("Flipping display")
-        if self._disp_rotate_180:
-            self._oled.rotation = 2
-        else:
-            self._oled.rotation = 0
+        self._use_display(self._create_display("main", self._disp_bus, self._disp_addr, self._disp_width, self._disp_height, self._disp_rotate_180, lock=self._display_lock))
+        self.build_compositor()
 
-        # Clear display.
-        self._oled.fill(0)
+    # Flip the main display without touching the driver: only the packing changes, and the next
+    # flush sends whatever that changed
+    def set_rotation(self, rotate_180):
+        # A hardware scroll would keep going the old way round, sprites are compiled for one rotation
+        self.stop_marquee()
+        self.stop_sprite()
+        self._disp_rotate_180 = rotate_180
+        self._logger.info("Flipping display")
+        self._display.set_rotation(2 if rotate_180 else 0)
 
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        self._disp_image = Image.new("1", (self._oled.width, self._oled.height))
+    # Select the glyph atlas for the current font face and size. The font is only read from disk when
+    # the atlas isn't cached yet.
+    def load_font(self):
+        from .layout import MIN_FIT_SIZE
+        with self._display_lock:
+            # Auto-fit may draw at any size from MIN_FIT_SIZE up to the font size, keep an atlas for each
+            # next to the widgets' sizes
+            self._glyph_cache.max_atlases = 4 + max(0, self._disp_font_size - MIN_FIT_SIZE)
+            self._disp_atlas = self._glyph_cache.get(self._disp_font_face, self._disp_font_size, self._read_font)
+            self._disp_font = self._disp_atlas.font
 
-        # Get drawing object to draw on image.
-        self._disp_draw = ImageDraw.Draw(self._disp_image)
+    def _read_font(self):
+        return self._read_font_size(self._disp_font_size)
 
-        if self._enabled:
-            try:
-                self._oled.show()
-            except OSError as os_err:
-                self._logger.error("IO error: " + str(os_err))
-            except Exception as err:
-                self._logger.error("Unknown error: " + str(err))
+    # The font at another size, shared by the glyph atlases and the text fitter
+    def _font(self, size):
+        return self._glyph_cache.font(self._disp_font_face, int(size), lambda: self._read_font_size(size))
+
+    def _read_font_size(self, size):
+        from PIL import ImageFont
+        self._logger.info("Loading font: " + self._disp_font_face + ".ttf (" + str(size) + "pt)")
+        return ImageFont.truetype(self._font_dir + self._disp_font_face + ".ttf", int(size))
+
+    # Copy the PIL image into the driver's buffer. Rotations 0 and 180 are packed with whole-image
+    # operations, anything else goes through the driver's per-pixel image().
+    def pack_frame(self):
+        self._display.pack()
+
+    # Send the driver's buffer to the display. Only the pages/columns that changed since the last
+    # flush are written (see FrameDiffer), inside one transfer on the display's bus.
+    # May throw
+    def flush_display(self, rects=None, base=None):
+        sent = self._display.flush(rects, base)
+        if self._preview is not None:
+            self._preview.notify()
+        return sent
+
+    # Current main display frame for the preview: (width, height, page data, rotation)
+    def _preview_frame(self):
+        if self._renderer is not None:
+            return self._renderer.frames.read()
+        with self._display_lock:
+            oled = self._display.oled
+            return oled.width, oled.height, bytes(oled.buffer[1:]), oled.rotation
+
+    def _send_preview(self, message):
+        self._plugin_manager.send_plugin_message(self._identifier, message)
+
+    # Pack and flush the image buffer, logging (not raising) bus errors
+    def commit_frame(self):
+        with self._display_lock:
+            self.pack_frame()
+            if self._enabled:
+                try:
+                    self.flush_display()
+                except OSError as os_err:
+                    self._logger.error("IO error: " + str(os_err))
+                except Exception as err:
+                    self._logger.error("Unknown error: " + str(err))
+            else:
+                self._logger.debug("Display disabled, skipping show()")
+
+    # Redraw whatever the current display_mode shows
+    def refresh_display(self):
+        mode = self._config.display_mode
+        if mode == "widgets":
+            self.show_widgets()
+        elif mode == "status":
+            self.show_text(self.format_status())
+        else:
+            self.show_text(self._config.display_text)
 
-        if self._anim_task is None:
-            self.show_text(self._settings.get(["display_text"]))
-    
     def show_text(self, text):
+        # Still starting up: keep the latest text in the (not yet running) update queue
+        if self._display is None:
+            self.queue_text(text)
+            return
         # Don't try to update the display if we're playing an animation
-        if self._anim_task != None:
-            self._logger.debug("Animation task is not None, skipping show_text")
+        if self._anim_task is not None and not self._anim_task.done:
+            self._logger.debug("Animation is playing, skipping show_text")
             return
-        # Clear image buffer by drawing a black filled box.
-        self._disp_draw.rectangle((0,0,self._oled.width,self._oled.height), outline=0, fill=0)
-        # Draw Some Text
-        (font_width, font_height) = self._disp_font.getsize(text)
-        self._disp_draw.text(
-            (self._oled.width // 2 - font_width // 2, self._oled.height // 2 - font_height // 2),
-            text,
-            font=self._disp_font,
-            fill=255,
-        )
         self._current_text = text
+        if self._should_scroll(text):
+            self.start_marquee(text)
+            return
+        self.stop_marquee()
+        with self._display_lock:
+            if self._compositor is not None:
+                self._compositor.invalidate()
+            # Draw Some Text
+            if self._config.auto_fit:
+                layout = self._fit_text(text)
+                self._display.draw_layout(self._fit_atlas(layout.size), layout)
+            else:
+                self._display.draw_centered_text(self._disp_atlas, text)
+
+            # Display image
+            self.commit_frame()
+
+    ##~ Status screen
+
+    # Create the widgets listed in the "widgets" setting
+    def build_compositor(self):
+        from .widgets import Compositor
+        try:
+            compositor = Compositor.from_settings(self._config.widgets, self._widget_atlas)
+        except (TypeError, ValueError) as err:
+            self._logger.error("Invalid widget configuration: " + str(err))
+            compositor = Compositor([], self._widget_atlas)
+        with self._display_lock:
+            self._compositor = compositor
+
+    def _widget_atlas(self, font_size):
+        if font_size is None or int(font_size) == self._disp_font_size:
+            return self._disp_atlas
+        return self._glyph_cache.get(self._disp_font_face, int(font_size), lambda: self._read_font_size(int(font_size)))
+
+    # Atlas for a size auto-fit picked. Only the glyphs of the fitted text get rasterized, as there is an
+    # atlas for every size it may pick.
+    def _fit_atlas(self, size):
+        if size == self._disp_font_size:
+            return self._disp_atlas
+        return self._glyph_cache.get(self._disp_font_face, size, lambda: self._read_font_size(size), preload="")
+
+    # Re-render the widgets whose data changed and flush only if anything did
+    def show_widgets(self):
+        if self._anim_task is not None and not self._anim_task.done:
+            return
+        self.stop_marquee()
+        with self._display_lock:
+            if not self._compositor.update(self._printer_state):
+                return
+            self._compositor.compose(self._disp_image)
+            self.commit_frame()
 
-        # Display image
-        self._oled.image(self._disp_image)
-        if self._enabled:
+    ##~ Extra displays
+    # Additional panels from the "extra_displays" setting. Each has its own image buffer and content
+    # (display_mode "text", "status" or "widgets") and shares the bus arbiter of its I2C bus.
+
+    def init_extra_displays(self):
+        from .settings import optional_int, parse_address
+        from .widgets import Compositor
+        configs = self._config.extra_displays
+        self._extra_display_configs = configs
+        self._extra_displays = []
+        for i, config in enumerate(configs):
+            name = config.get("name", "display" + str(i + 1))
             try:
-                self._oled.show()
-            except OSError as os_err:
-                self._logger.error("IO error: " + str(os_err))
+                display = self._create_display(
+                    name,
+                    optional_int(config.get("bus", self._disp_bus)),
+                    parse_address(config.get("address", "0x3D")),
+                    int(config.get("width", self._disp_width)),
+                    int(config.get("height", self._disp_height)),
+                    config.get("rotate_180", False)
+                )
+                display.config = config
+                display.compositor = Compositor.from_settings(config.get("widgets", self._config.widgets), self._widget_atlas)
             except Exception as err:
-                self._logger.error("Unknown error: " + str(err))
-        else:
-            self._logger.info("show_text: Display disabled, skipping show()")
+                self._logger.error("Failed to initialize display " + name + ": " + str(err))
+                continue
+            self._extra_displays.append(display)
+        self.refresh_extra_displays()
+
+    # Redraw the extra displays. With only_status set, displays showing fixed text are skipped.
+    def refresh_extra_displays(self, only_status=False):
+        for display in self._extra_displays:
+            mode = display.config.get("display_mode", "text")
+            if only_status and mode == "text":
+                continue
+            with display.lock:
+                if mode == "widgets":
+                    if not display.compositor.update(self._printer_state):
+                        continue
+                    display.compositor.compose(display.image)
+                elif mode == "status":
+                    display.draw_centered_text(self._disp_atlas, self.format_status(display.config.get("status_format")))
+                else:
+                    display.draw_centered_text(self._disp_atlas, display.config.get("display_text", ""))
+                display.pack()
+                if not self._enabled:
+                    continue
+                try:
+                    display.flush()
+                except OSError as os_err:
+                    self._logger.error("IO error on display " + display.name + ": " + str(os_err))
+                except Exception as err:
+                    self._logger.error("Unknown error on display " + display.name + ": " + str(err))
+
+    ##~ Scrolling text
+
+    # scroll_mode: "off", "overflow" (only text wider than the display) or "always"
+    def _should_scroll(self, text):
+        mode = self._config.scroll_mode
+        if mode == "always":
+            return len(text) > 0
+        if mode == "overflow":
+            # Auto-fit text only scrolls if it doesn't even fit at the smallest size
+            if self._config.auto_fit:
+                return not self._fit_text(text).fits
+            return self._disp_atlas.getsize(text)[0] > self._oled.width
+        return False
+
+    # Largest size up to display_font_size (and line breaks) at which text fits the main display
+    def _fit_text(self, text):
+        return self._text_fitter.fit(text, self._oled.width, self._oled.height, self._disp_font_size)
+
+    # Scroll text across the display, replacing any text that is already scrolling. The controller does
+    # it by itself when it can, otherwise frames are rendered on the render loop. A marquee that is
+    # already running keeps going: untouched for the same text (status updates repeat it all the time),
+    # from the same scroll position for new text at the same speed.
+    def start_marquee(self, text):
+        from .marquee import Marquee
+        fps = self._config.scroll_fps
+        speed = self._config.scroll_speed
+        if self._start_hardware_scroll(text, speed):
+            return
+        self._stop_hardware_scroll()
+        with self._display_lock:
+            source = (text, self._disp_atlas, self._oled.width, self._oled.height)
+            running = self._marquee_task is not None and not self._marquee_task.done and self._marquee_rate == (fps, speed)
+            if running and self._marquee_source == source:
+                return
+            self._marquee = Marquee(self._disp_atlas, text, self._oled.width, self._oled.height)
+            self._marquee_source = source
+            if running:
+                return
+        self._marquee_rate = (fps, speed)
+        self._marquee_task = self._render_loop.play(self._marquee_frames(speed / fps), fps=fps, flush=self._flush_frame, name="marquee")
+
+    def stop_marquee(self):
+        self._stop_hardware_scroll()
+        if self._marquee_task is None:
+            return
+        self._marquee_task.cancel()
+        self._marquee_task.wait(1.0)
+        self._marquee_task = None
+
+    # Hardware scrolling (see hwscroll.py): the text is drawn and flushed once, then the controller
+    # moves it and the bus stays idle. Only works for text that fits on a full-width (128 column) panel
+    # and speeds close to one of the controller's step intervals. Returns False if the text has to be
+    # scrolled in software.
+    def _start_hardware_scroll(self, text, speed):
+        from .hwscroll import RAM_COLUMNS, plan_scroll
+        display = self._display
+        if not self._config.scroll_hardware or not self._enabled or display.oled.width != RAM_COLUMNS:
+            return False
+        if self._disp_atlas.getsize(text)[0] > display.oled.width:
+            return False
+        plan = plan_scroll(speed, display.oled.height)
+        if plan is None:
+            self._logger.debug("No hardware scroll interval close to " + str(speed) + " px/s, scrolling in software")
+            return False
+        frames, actual = plan
+        source = (text, self._disp_atlas, display.oled.width, display.oled.height)
+        if display.hw_scroll == frames and self._hw_scroll_source == source:
+            return True
+        self.stop_marquee()
+        with self._display_lock:
+            if self._compositor is not None:
+                self._compositor.invalidate()
+            display.draw_centered_text(self._disp_atlas, text)
+            self.commit_frame()
+            try:
+                display.start_scroll(frames)
+            except Exception as err:
+                self._logger.error("Failed to start hardware scroll: " + str(err))
+                return False
+        self._hw_scroll_source = source
+        self._logger.info("Scrolling in hardware at " + str(round(actual, 1)) + " px/s (every " + str(frames) + " frames)")
+        return True
+
+    # The panel's RAM is left shifted, so the next flush rewrites all of it
+    def _stop_hardware_scroll(self):
+        self._hw_scroll_source = None
+        display = self._display
+        if display is None or display.hw_scroll is None:
+            return
+        try:
+            display.stop_scroll()
+        except Exception as err:
+            self._logger.error("Failed to stop hardware scroll: " + str(err))
+
+    # Frame generator for self._marquee (which start_marquee may swap): `velocity` is in pixels per frame
+    def _marquee_frames(self, velocity):
+        pos = 0.0
+        while True:
+            with self._display_lock:
+                self._marquee.render(self._disp_image, pos)
+            steps = yield
+            pos += velocity * steps
 
     ##~ Animations
 
-    # # ATTRIBUTION FOR _play_demo_animation_fn():
+    # # ATTRIBUTION FOR _demo_animation_frames():
     # # Copyright (c) 2014 Adafruit Industries
     # # Author: Tony DiCola
     # # 
@@ -154,136 +543,492 @@ class OctOLEDPlugin(octoprint.plugin.SettingsPlugin,
     # # THE SOFTWARE.
     # https://github.com/adafruit/Adafruit_Python_SSD1306/blob/master/examples/animate.py
 
+    # Frame generator for the render loop: draws one frame per iteration and is sent the number of
+    # frame slots that elapsed since the previous frame (more than 1 if frames were dropped).
+    # The text is rendered once into a Marquee strip and the sine wave comes from a lookup table.
+    def _demo_animation_frames(self):
+        from .marquee import Marquee, sine_table
+        # Define text
+        text = 'SSD1306 ORGANIC LED DISPLAY. THIS IS AN OLD SCHOOL DEMO SCROLLER!! GREETZ TO: LADYADA & THE ADAFRUIT CREW, TRIXTER, FUTURE CREW, AND FARBRAUSCH'
+        # Set animation and sine wave parameters.
+        width = self._oled.width
+        amplitude = width/4
+        offset = self._oled.height/2 - 4
+        velocity = -2
+        with self._display_lock:
+            # Leave a display-wide gap so the text scrolls in from the right edge each time around
+            marquee = Marquee(self._disp_atlas, text, width, self._oled.height, gap=width, y=offset,
+                              wave=sine_table(width, amplitude))
+
+        # Animate text moving in sine wave, starting just off the right side of the screen.
+        pos = -width
+        while True:
+            with self._display_lock:
+                marquee.render(self._disp_image, pos)
+            # Hand the frame to the render loop, which flushes it and tells us how far to move.
+            steps = yield
+            pos -= velocity * steps
+
+    # Flush callback for the render loop, runs on the render thread
     # May throw
-    # TODO: Get this to work with asyncio
-    def _play_demo_animation_fn(self):
+    def _flush_frame(self):
         if not self._enabled:
             return
-        # Clear image buffer by drawing a black filled box.
-        self._disp_draw.rectangle((0,0,self._oled.width,self._oled.height), outline=0, fill=0)
-        self._logger.info("Demo animation started")
-        # Define text and get total width.
-        text = 'SSD1306 ORGANIC LED DISPLAY. THIS IS AN OLD SCHOOL DEMO SCROLLER!! GREETZ TO: LADYADA & THE ADAFRUIT CREW, TRIXTER, FUTURE CREW, AND FARBRAUSCH'
-        maxwidth, unused = self._disp_draw.textsize(text, font=self._disp_font)
-        try:
-            # Set animation and sine wave parameters.
-            amplitude = self._oled.width/4
-            offset = self._oled.height/2 - 4
-            velocity = -2
-            startpos = self._oled.width
-
-            # Animate text moving in sine wave.
-            pos = startpos
-            while True:
-                # Clear image buffer by drawing a black filled box.1
-                self._disp_draw.rectangle((0,0,self._oled.width,self._oled.height), outline=0, fill=0)
-                # Enumerate characters and draw them offset vertically based on a sine wave.
-                x = pos
-                for i, c in enumerate(text):
-                    # Stop drawing if off the right side of screen.
-                    if x > self._oled.width:
-                        break
-                    # Calculate width but skip drawing if off the left side of screen.
-                    if x < -10:
-                        char_width, char_height = self._disp_draw.textsize(c, font=self._disp_font)
-                        x += char_width
-                        continue
-                    # Calculate offset from sine wave.
-                    y = offset+math.floor(amplitude*math.sin(x/float(self._oled.width)*2.0*math.pi))
-                    # Draw text.
-                    self._disp_draw.text((x, y), c, font=self._disp_font, fill=255)
-                    # Increment x position based on chacacter width.
-                    char_width, char_height = self._disp_draw.textsize(c, font=self._disp_font)
-                    x += char_width
-                # Draw the image buffer.
-                self._oled.image(self._disp_image)
-                self._oled.show()
-                # Move position for next frame.
-                pos += velocity
-                # Start over if text has scrolled completely off left side of screen.
-                if pos < -maxwidth:
-                    pos = startpos
-                # Pause briefly before drawing next frame.
-                time.sleep(0.1)
-        except asyncio.CancelledError:
-            self._logger.info('Demo animation cancelled')
-            raise
-        except Exception as err:
-            self._logger.error("Unknown error: " + str(err))
-            raise
-
-    # TODO: Fix this
-    async def _play_demo_animation_wrapper(self):
-        self._anim_task = asyncio.create_task(self._play_demo_animation_fn())
-        await self._anim_task
-    
-    # TODO: Fix this
+        with self._display_lock:
+            self.pack_frame()
+            self.flush_display()
+
+    # Start the demo on the render loop, returns immediately
     def play_demo_animation(self):
-        asyncio.run(self._play_demo_animation_wrapper())
+        if not self._enabled:
+            return
+        if self._anim_task is not None and not self._anim_task.done:
+            return
+        self.stop_marquee()
+        self._anim_task = self._render_loop.play(self._demo_animation_frames(), fps=10, flush=self._flush_frame, name="demo")
+
+    ##~ Pushed frames
+    # Frames rendered somewhere else, as packed 1-bit bytes in the panel's own page order (rotate_180
+    # isn't applied). They go straight into the driver's buffer and only the changed part is sent.
+    # The next text/status update from OctOLED itself draws over them.
+
+    # push_frame helper for other plugins. `data` is a bytes-like object with the whole frame or only
+    # `box` = (x, y, width, height), y and height being multiples of 8. Returns the number of bytes
+    # sent, or None if the display isn't available. Raises ValueError on malformed frames.
+    def push_frame(self, data, box=None):
+        if self._governor is not None:
+            self._governor.activity()
+        if self._renderer is not None:
+            return self._renderer.push_frame(data, box)
+        if self._display is None:
+            return None
+        # Animations own the display while they play
+        if self._anim_task is not None and not self._anim_task.done:
+            return None
+        self.stop_marquee()
+        with self._display_lock:
+            self._display.write_frame(data, box)
+            self._pushed_frames += 1
+            if not self._enabled:
+                return 0
+            return self.flush_display()
+
+    ##~ Display lists
+    # Whole screens drawn by other plugins or through the API in one call (see drawlist.py for the
+    # operations). Like pushed frames, the next text/status update from OctOLED itself draws over them.
+
+    # draw helper for other plugins. The batch is validated first, then drawn into the display image
+    # (cleared first unless clear is False) and flushed once. Returns the timings as
+    # dict(operations, validate_ms, render_ms, flush_ms, bytes_sent), or None if the display is busy or
+    # not initialized. Raises ValueError on invalid batches.
+    def draw(self, ops, clear=True):
+        from .drawlist import compile_display_list, render
+        if self._governor is not None:
+            self._governor.activity()
+        if self._renderer is not None:
+            return self._renderer.call("draw", ops, clear)
+        if self._display is None:
+            return None
+        if self._anim_task is not None and not self._anim_task.done:
+            return None
+        start = time.monotonic()
+        compiled = compile_display_list(ops, self._oled.width, self._oled.height, self._widget_atlas)
+        validated = time.monotonic()
+        self.stop_marquee()
+        with self._display_lock:
+            if self._compositor is not None:
+                self._compositor.invalidate()
+            if clear:
+                self._display.clear()
+            render(compiled, self._disp_image)
+            self.pack_frame()
+            rendered = time.monotonic()
+            sent = self.flush_display() if self._enabled else 0
+            flushed = time.monotonic()
+        return dict(
+            operations=len(compiled),
+            validate_ms=(validated - start) * 1000,
+            render_ms=(rendered - validated) * 1000,
+            flush_ms=(flushed - rendered) * 1000,
+            bytes_sent=sent
+        )
+
+    ##~ Sprites
+    # GIFs, APNGs and directories of images, compiled into packed frames for the main display's size
+    # and rotation (see sprites.py) and played on the render loop. Only the first play of a source at a
+    # given geometry decodes it, later ones map the cached file.
+
+    # play_sprite helper for other plugins: `source` is a file or directory path. Replaces a sprite
+    # that is already playing. Returns the number of frames, or None if the display isn't available.
+    # May throw (OSError, ValueError) on sources that can't be read.
+    def play_sprite(self, source, loop=True):
+        from .sprites import SpritePlayer
+        if self._governor is not None:
+            self._governor.activity()
+        if self._renderer is not None:
+            from .render_process import HANG_TIMEOUT
+            # Compiling a sprite can take a while, but a worker busy for longer than HANG_TIMEOUT is
+            # restarted anyway
+            return self._renderer.call("play_sprite", source, loop, timeout=HANG_TIMEOUT)
+        if self._display is None or not self._enabled:
+            return None
+        if self._anim_task is not None and not self._anim_task.done and self._anim_task.name != "sprite":
+            return None
+        with self._display_lock:
+            display = self._display
+            width, height, rotation = display.oled.width, display.oled.height, display.oled.rotation
+        # Compiling can take a moment, don't hold up flushes meanwhile
+        sprite = self._sprite_cache.get(source, width, height, rotation)
+        self.stop_marquee()
+        player = SpritePlayer(sprite, display.write_frame, loop=loop)
+        fps = 1.0 / max(min(sprite.durations), 0.01)
+        self._anim_task = self._render_loop.play(player.run, fps=fps, flush=lambda: self._flush_sprite(player), name="sprite")
+        self._anim_task.add_done_callback(self._on_sprite_done)
+        self._logger.info("Playing sprite " + source + " (" + str(len(sprite)) + " frames)")
+        return len(sprite)
+
+    def stop_sprite(self):
+        if self._renderer is not None:
+            self._renderer.send("stop_sprite")
+            return
+        task = self._anim_task
+        if task is None or task.name != "sprite":
+            return
+        self._anim_task = None
+        task.cancel()
+        task.wait(1.0)
+
+    # Flush callback for sprites: sends the windows compiled into the sprite
+    # May throw
+    def _flush_sprite(self, player):
+        if not self._enabled:
+            return
+        with self._display_lock:
+            self.flush_display(*player.pending)
+
+    # A sprite that finished (or failed) by itself gives the display back
+    def _on_sprite_done(self, animation):
+        if self._anim_task is animation:
+            self._anim_task = None
+            self.queue_update("redraw", True)
+
+    ##~ Queued updates
+    # Everything coming from OctoPrint's threads goes through the update queue, which coalesces bursts
+    # and renders on its own thread at no more than max_refresh_rate
+
+    # show_text helper for other plugins: returns immediately, the text is drawn on the update thread
+    def queue_text(self, text):
+        if self._governor is not None:
+            self._governor.activity()
+        self.queue_update("text", text)
+
+    def queue_update(self, key, value):
+        if self._update_queue is not None:
+            self._update_queue.submit(key, value)
+
+    # Runs on the update thread with the latest value for every key that changed since the last refresh
+    def _apply_updates(self, updates):
+        if self._renderer is not None:
+            self._forward_updates(updates)
+            return
+        text = updates.pop("text", None)
+        redraw = updates.pop("redraw", False)
+        self._printer_state.update(updates)
+        mode = self._config.display_mode
+        if text is not None:
+            self.show_text(text)
+        elif redraw:
+            self.refresh_display()
+        elif updates and mode == "widgets":
+            self.show_widgets()
+        elif updates and mode == "status":
+            self.show_text(self.format_status())
+        if updates:
+            self.refresh_extra_displays(only_status=True)
+
+    # Render process mode: the worker draws the updates, the plugin keeps the latest state for a worker
+    # that has to replace it
+    def _forward_updates(self, updates):
+        if "text" in updates:
+            self._current_text = updates["text"]
+        self._printer_state.update((key, value) for key, value in updates.items() if key not in ("text", "redraw"))
+        self._renderer.send("updates", updates)
+
+    # A worker replaced after a crash starts from the settings, bring it up to date
+    def _on_renderer_restart(self):
+        self._renderer.send("suspend", self._asleep, self._render_max_fps)
+        updates = dict(self._printer_state)
+        if self._current_text is not None:
+            updates["text"] = self._current_text
+        else:
+            updates["redraw"] = True
+        self._renderer.send("updates", updates)
+
+    # Fill in status_format from the latest printer state, unknown values are shown as "-"
+    def format_status(self, status_format=None):
+        from .widgets import StatusValues
+        if status_format is None:
+            status_format = self._config.status_format
+        try:
+            return status_format.format_map(StatusValues(self._printer_state))
+        except (ValueError, IndexError) as err:
+            self._logger.error("Invalid status format: " + str(err))
+            return status_format
+
+    def _on_printer_event(self, event, payload):
+        if self._governor is not None and (event in PRINT_STATE_EVENTS or event == "ZChange"):
+            self._governor.on_event(event, payload)
+        if event in PRINT_STATE_EVENTS:
+            self.queue_update("state", PRINT_STATE_EVENTS[event])
+            if event == "PrintStarted":
+                self.queue_update("file", payload.get("name", ""))
+                self.queue_update("progress", "0")
+        elif event == "ZChange":
+            if payload.get("new") is not None:
+                self.queue_update("z", "{0:.2f}".format(payload["new"]))
+        elif event == "PositionUpdate":
+            for axis in ("x", "y", "z"):
+                if payload.get(axis) is not None:
+                    self.queue_update(axis, "{0:.1f}".format(payload[axis]))
+
+    # Feeds ClockWidget, only needed while the status screen is shown. Also lets an idle display fall asleep.
+    def _tick_clock(self):
+        self._governor.tick()
+        if self._config.display_mode == "widgets":
+            self.queue_update("time", int(time.time()))
+
+    ##~ Refresh governor
+    # The update queue's rate follows the printer's state (see governor.py), and past the first layer
+    # animations (software scrolling, the demo, sprites) are capped to it too. Nothing is rendered or
+    # flushed while the plugin is disabled or the display sleeps: updates are held in the queue and
+    # animations are paused, and a sleeping panel is switched off.
+
+    # Refreshes/sec for each governor state
+    def _governor_rates(self):
+        config = self._config
+        if not config.adaptive_refresh:
+            return dict(first_layer=config.max_refresh_rate, printing=config.max_refresh_rate, paused=config.max_refresh_rate,
+                        idle=config.max_refresh_rate, asleep=0.0)
+        return dict(
+            first_layer=config.max_refresh_rate,
+            printing=min(config.printing_refresh_rate, config.max_refresh_rate),
+            paused=config.max_refresh_rate,
+            idle=min(config.idle_refresh_rate, config.max_refresh_rate),
+            asleep=0.0
+        )
+
+    def _governor_sleep_after(self):
+        return self._config.sleep_timeout if self._config.adaptive_refresh else 0
+
+    # Called by the governor on every state change
+    def _on_governor_change(self, state, rate):
+        self._logger.info("Display refresh: " + state + " (" + str(rate) + " updates/s)")
+        self._asleep = state == "asleep"
+        self._render_max_fps = rate if state == "printing" and self._config.adaptive_refresh else None
+        if rate > 0 and self._update_queue is not None:
+            self._update_queue.set_max_rate(rate)
+        self._update_suspension()
+
+    def _update_suspension(self):
+        if self._update_queue is not None:
+            if self._asleep or not self._enabled:
+                self._update_queue.pause()
+            else:
+                self._update_queue.resume()
+        if self._renderer is not None:
+            self._renderer.send("suspend", self._asleep, self._render_max_fps)
+            return
+        self._suspend_displays()
+
+    # Pause animations while suspended, cap their frame rate while printing and switch the panels off
+    # while asleep
+    def _suspend_displays(self):
+        asleep = self._asleep
+        suspended = asleep or not self._enabled
+        if self._render_loop is not None:
+            self._render_loop.set_max_fps(self._render_max_fps)
+        animation = self._render_loop.current if self._render_loop is not None else None
+        if animation is not None and not animation.done:
+            if suspended:
+                animation.pause()
+            else:
+                animation.resume()
+        if not self._enabled or self._display is None:
+            return
+        for display in [self._display] + self._extra_displays:
+            if display.powered != asleep:
+                continue
+            try:
+                display.set_power(not asleep)
+            except Exception as err:
+                self._logger.error("Failed to switch display " + display.name + (" off: " if asleep else " on: ") + str(err))
+
+    ##~ ProgressPlugin mixin
+    def on_print_progress(self, storage, path, progress):
+        self.queue_update("progress", str(progress))
+        time_left = self._printer.get_current_data().get("progress", dict()).get("printTimeLeft")
+        if time_left is not None:
+            self.queue_update("eta", format_duration(time_left))
+
+    ##~ Temperature hook
+    # Called on OctoPrint's comm thread for every temperature report, must return quickly
+    def on_temperatures_received(self, comm, parsed, *args, **kwargs):
+        for heater, (actual, target) in parsed.items():
+            key = HEATER_KEYS.get(heater, heater.lower().replace("t", "tool", 1))
+            if actual is not None:
+                self.queue_update(key, "{0:.0f}".format(actual))
+            if target is not None:
+                self.queue_update(key + "_target", "{0:.0f}".format(target))
+        return parsed
 
     ##~ EventHandlerPlugin mixin
     def on_event(self, event, payload):
         # self._logger.debug("Event payload: " + str(payload))
         # TODO: Massively refactor this, please
-        if event == "SettingsUpdated":
-            self._logger.info("Updating display settings...")
-            self._enabled = self._settings.get(["enabled"])
-
-            self._logger.info("Display enabled: " + str(self._settings.get(["enabled"])))
-            self._logger.debug("Display Width: " + str(self._settings.get(["display_width"])))
-            self._logger.debug("Display Height: " + str(self._settings.get(["display_height"])))
-            self._logger.debug("Display Rotation: " + str(self._settings.get(["rotate_180"])))
-            self._logger.debug("Display Text: " + str(self._settings.get(["display_text"])))
-            self._logger.debug("Display Font Size: " + str(self._settings.get(["display_font_size"])))
-            self._logger.debug("Display Demo Animation: " + str(self._settings.get(["demo_anim"])))
-
-            # Set display
-            width = self._settings.get(["display_width"])
-            height = self._settings.get(["display_height"])
-            r180 = self._settings.get(["rotate_180"])
-            if width != self._disp_width or height != self._disp_height or r180 != self._disp_rotate_180:
+        if event in PRINT_STATE_EVENTS or event in ("ZChange", "PositionUpdate"):
+            self._on_printer_event(event, payload or dict())
+        elif event in ACTIVITY_EVENTS:
+            if self._governor is not None:
+                self._governor.activity()
+        elif event == "SettingsUpdated":
+            if self._init_state != "ready":
+                # _init_worker picks them up once the display is ready
+                self._logger.info("Display not initialized, settings will be applied on initialization")
+                return
+            self._governor.activity()
+            self.reload_settings()
+
+    # Take a new settings snapshot and apply whatever changed since the last one
+    def reload_settings(self):
+        try:
+            config = SettingsSnapshot.read(self._settings)
+        except (TypeError, ValueError) as err:
+            self._logger.error("Invalid settings, keeping the previous ones: " + str(err))
+            return
+        changed = config.changed(self._config)
+        self._config = config
+        self.apply_settings(changed)
+
+    # Update only the parts of the plugin whose settings changed. Nothing is sent to the displays
+    # unless what they show changed.
+    def apply_settings(self, changed):
+        config = self._config
+        if not changed:
+            self._logger.debug("No display settings changed")
+            return
+        self._logger.info("Updating display settings: " + ", ".join(sorted(changed)))
+        self._enabled = config.enabled
+
+        if changed & GOVERNOR_SETTINGS:
+            self._governor.configure(self._governor_rates(), self._governor_sleep_after())
+
+        if "preview_rate" in changed and self._preview is not None:
+            self._preview.set_max_rate(config.preview_rate)
+
+        if "render_process" in changed:
+            self._logger.info("Render process setting will be applied after a restart")
+
+        if self._renderer is not None:
+            if changed & REDRAW_SETTINGS:
+                self._current_text = None
+            self._renderer.send("settings", config.as_dict(), sorted(changed))
+        else:
+            self._apply_display_settings(changed)
+
+        if "enabled" in changed:
+            self._update_suspension()
+
+        self._logger.info("Updated settings")
+
+    # The part of apply_settings that touches the displays, runs wherever the rendering happens
+    def _apply_display_settings(self, changed):
+        config = self._config
+        redraw = bool(changed & REDRAW_SETTINGS)
+
+        if changed & {"i2c_chunk_size", "i2c_retries", "i2c_retry_backoff_ms"}:
+            for display in [self._display] + self._extra_displays:
+                display.transport.configure(**self._transport_options())
+
+        if "i2c_frequency" in changed:
+            self._logger.info("New I2C bus speed will be used after a restart")
+
+        # The buses opened so far belong to the current backend
+        if "display_backend" in changed:
+            self._logger.info("New display backend will be used after a restart")
+
+        # Set display
+        if changed & DRIVER_SETTINGS:
+            try:
                 self.change_resolution()
+            except Exception as err:
+                self._logger.error("Failed to set up the display: " + str(err))
+                return
+            redraw = True
+        elif "rotate_180" in changed:
+            self.set_rotation(config.rotate_180)
+            redraw = True
+
+        # Set text
+        if "display_font_size" in changed:
+            self._disp_font_size = config.display_font_size
+            self.load_font()
+            self.build_compositor()
+            redraw = True
+        elif "widgets" in changed:
+            self.build_compositor()
 
-            # Set text
-            new_text = self._settings.get(["display_text"])
-            new_text_size = int(self._settings.get(["display_font_size"]))
-
-            if int(self._disp_font_size) != new_text_size:
-                self._disp_font_size = new_text_size
-                self._logger.info("Reloading font: " + self._disp_font_face + ".ttf")
-                self._disp_font = ImageFont.truetype(self._font_dir + self._disp_font_face + ".ttf", int(self._disp_font_size))
-                
-            # Set animation
-            if self._settings.get(["demo_anim"]) == True:
+        # Set animation
+        if "demo_anim" in changed:
+            if config.demo_anim:
                 self._logger.info("Playing demo animation...")
                 self.play_demo_animation()
-            elif self._anim_task != None:
-                    self._logger.info("Cancelling demo animation")
-                    self._anim_task.cancel()
-                    self._anim_task = None
+            elif self._anim_task is not None:
+                self._logger.info("Cancelling demo animation")
+                self._anim_task.cancel()
+                self._anim_task.wait(1.0)
+                self._anim_task = None
+                redraw = True
 
-            if not self._settings.get(["enabled"]):
-                self._oled.fill(0)
-                try:
-                    self._oled.show()
-                except Exception as err:
-                    self._logger.info("Failed to clear display")
+        if "enabled" in changed:
+            if not config.enabled:
+                self.stop_marquee()
+                for display in [self._display] + self._extra_displays:
+                    display.oled.fill(0)
+                    try:
+                        display.flush()
+                    except Exception as err:
+                        self._logger.info("Failed to clear display " + display.name)
+                redraw = False
+            else:
+                redraw = True
 
-            if self._anim_task is None:
-                self._logger.info("Updating display text")
-                self.show_text(new_text)
+        if redraw and config.enabled and (self._anim_task is None or self._anim_task.done):
+            self._logger.info("Updating display text")
+            if self._compositor is not None:
+                self._compositor.invalidate()
+            self.refresh_display()
 
-            self._logger.info("Updated settings")
+        if "extra_displays" in changed:
+            self.init_extra_displays()
+        elif config.enabled and (changed & {"display_font_size", "widgets", "enabled"}):
+            self.refresh_extra_displays()
 
     ##~ SimpleApiPlugin mixin
-    # TODO: Implement plugin API
     def get_api_commands(self):
         return dict(
             # show_text=["text"]
-            apply_settings=[]
+            apply_settings=[],
+            # frame: base64 of the packed frame, box (optional): [x, y, width, height]
+            push_frame=["frame"],
+            # client: id of the browser tab, active (default true), key_frame (optional)
+            preview=["client"],
+            # name: file or directory in the plugin's "sprites" data folder, loop (default true)
+            play_sprite=["name"],
+            stop_sprite=[],
+            # ops: list of drawing operations (see drawlist.py), clear (default true)
+            draw=["ops"]
         )
 
-    # TODO: Implement plugin API
     def on_api_command(self, command, data):
         import flask
         # if command == "show_text":
@@ -292,6 +1037,58 @@ class OctOLEDPlugin(octoprint.plugin.SettingsPlugin,
         # elif command == "command2":
         #     self._logger.info("command2 called, some_parameter is {some_parameter}".format(**data))
 
+        if command == "preview":
+            if self._preview is None:
+                return flask.make_response(flask.jsonify(error="Display not initialized"), 409)
+            if data.get("active", True):
+                self._preview.subscribe(str(data["client"]), key_frame=bool(data.get("key_frame", False)))
+            else:
+                self._preview.unsubscribe(str(data["client"]))
+            return flask.jsonify(max_rate=self._preview.max_rate)
+
+        if command == "push_frame":
+            try:
+                frame = base64.b64decode(data["frame"], validate=True)
+                start = time.monotonic()
+                sent = self.push_frame(frame, data.get("box"))
+            except (TypeError, ValueError, binascii.Error) as err:
+                return flask.make_response(flask.jsonify(error=str(err)), 400)
+            except OSError as os_err:
+                self._logger.error("IO error: " + str(os_err))
+                return flask.make_response(flask.jsonify(error="IO error: " + str(os_err)), 500)
+            if sent is None:
+                return flask.make_response(flask.jsonify(error="Display is busy or not initialized"), 409)
+            return flask.jsonify(bytes_sent=sent, time_ms=(time.monotonic() - start) * 1000)
+
+        if command == "draw":
+            try:
+                timings = self.draw(data["ops"], clear=bool(data.get("clear", True)))
+            except ValueError as err:
+                return flask.make_response(flask.jsonify(error=str(err)), 400)
+            except OSError as os_err:
+                self._logger.error("IO error: " + str(os_err))
+                return flask.make_response(flask.jsonify(error="IO error: " + str(os_err)), 500)
+            if timings is None:
+                return flask.make_response(flask.jsonify(error="Display is busy or not initialized"), 409)
+            return flask.jsonify(**timings)
+
+        if command == "play_sprite":
+            folder = os.path.realpath(os.path.join(self.get_plugin_data_folder(), "sprites"))
+            path = os.path.realpath(os.path.join(folder, str(data["name"])))
+            if not path.startswith(folder + os.sep) or not os.path.exists(path):
+                return flask.make_response(flask.jsonify(error="No such sprite: " + str(data["name"])), 404)
+            try:
+                frames = self.play_sprite(path, loop=bool(data.get("loop", True)))
+            except (OSError, ValueError) as err:
+                return flask.make_response(flask.jsonify(error=str(err)), 400)
+            if frames is None:
+                return flask.make_response(flask.jsonify(error="Display is busy or not initialized"), 409)
+            return flask.jsonify(frames=frames)
+
+        if command == "stop_sprite":
+            self.stop_sprite()
+            self.queue_update("redraw", True)
+
         # TODO: Unfinished
         # if command == "apply_settings":
         #     self.apply_settings()
@@ -299,34 +1096,151 @@ class OctOLEDPlugin(octoprint.plugin.SettingsPlugin,
 
         return flask.jsonify(result="200 OK")
 
-    # TODO: Implement plugin API
     def on_api_get(self, request):
-        return flask.jsonify(text=self._settings.get(["display_text"]))
+        if self._renderer is not None:
+            display_stats = self._renderer.call("stats") or dict()
+        else:
+            display_stats = self._display_stats()
+        return flask.jsonify(
+            text=self._config.display_text,
+            updates=self._update_queue.stats() if self._update_queue is not None else None,
+            governor=self._governor.stats() if self._governor is not None else None,
+            startup=dict(state=self._init_state, timings_ms=self._startup_timings),
+            preview=self._preview.stats() if self._preview is not None else None,
+            render_process=self._renderer.stats() if self._renderer is not None else None,
+            # 9 clock cycles per byte (8 bits + ACK) is the most the bus can carry
+            i2c=dict(
+                frequency=self._config.i2c_frequency,
+                max_bytes_per_second=self._config.i2c_frequency // 9
+            ),
+            **display_stats
+        )
+
+    # Stats of the displays and everything drawing on them, from wherever the rendering happens
+    def _display_stats(self):
+        return dict(
+            frame_stats=self._frame_differ.stats.as_dict() if self._frame_differ is not None else None,
+            animation=self._render_loop.stats() if self._render_loop is not None else None,
+            displays=[display.stats() for display in [self._display] + self._extra_displays if display is not None],
+            buses=self._buses.stats() if self._buses is not None else None,
+            pushed_frames=self._pushed_frames,
+            sprites=self._sprite_cache.stats() if self._sprite_cache is not None else None,
+            layout=self._text_fitter.stats() if self._text_fitter is not None else None
+        )
 
     ##~~ StartupPlugin mixin
     def on_startup(self, _host, _port):
         self._logger.info("Initializing OctOLED...")
 
+    # Opening the display can take a while (or hang on a bad bus), so it happens on a background thread.
+    # Updates submitted meanwhile wait in the update queue, which is only started once the display is up.
     def on_after_startup(self):
-        self._enabled = self._settings.get(["enabled"])
+        # Settings are saved before reload_settings() can reject them, so a typo must not stop the plugin
+        # from starting
+        self._config = SettingsSnapshot.read(self._settings, defaults=self.get_settings_defaults())
+        for name in self._config.invalid:
+            self._logger.error("Invalid setting " + name + " (" + repr(self._settings.get([name])) + "), using the default")
+        self._enabled = self._config.enabled
+        self._update_queue = UpdateQueue(self._apply_updates, self._logger, max_rate=self._config.max_refresh_rate)
+        self._governor = RefreshGovernor(self._on_governor_change, self._governor_rates(), self._governor_sleep_after())
+        self._update_queue.set_max_rate(self._governor.rate)
         self._logger.info("Enabled: %s" % str(self._enabled))
-        self._logger.info("Display Resolution: {0}x{1} (width x height)".format(self._settings.get(["display_width"]), self._settings.get(["display_height"])))
-        error = False
+        self._logger.info("Display Resolution: {0}x{1} (width x height)".format(self._config.display_width, self._config.display_height))
+        timeout = self._config.init_timeout
+        self._init_watchdog = threading.Timer(timeout, self._on_init_timeout, args=(timeout,))
+        self._init_watchdog.daemon = True
+        self._init_watchdog.start()
+        threading.Thread(target=self._init_worker, name="OctOLED-init", daemon=True).start()
+
+    def _init_worker(self):
+        started = time.monotonic()
+        error = None
         try:
-            self.init_display()
+            from .preview import PreviewStream
+            self._preview = PreviewStream(self._preview_frame, self._send_preview, self._logger, max_rate=self._config.preview_rate)
+            if self._config.render_process:
+                self.start_renderer()
+            else:
+                from .animation import RenderLoop
+                self._render_loop = RenderLoop(self._logger)
+                self._startup_phase("render loop", started)
+                self.init_display()
         except ValueError as init_error:
-            self._logger.error("Failed to initialize! Display not found: " + str(init_error))
-            error = True
+            error = "Display not found: " + str(init_error)
         except Exception as err:
-            self._logger.error("Failed to initialize! Unknown error: " + str(err))
-            error = True
-        else:
-            self._logger.info("Initialization complete.")
-        finally:
-            if error and self._enabled:
+            error = "Unknown error: " + str(err)
+        self._init_watchdog.cancel()
+        with self._init_lock:
+            timed_out = self._init_state == "timeout"
+            if not timed_out:
+                self._init_state = "failed" if error is not None else "ready"
+        elapsed = (time.monotonic() - started) * 1000
+        self._startup_timings["total"] = elapsed
+
+        if timed_out:
+            self._logger.warning("Display initialization finished after {0:.0f} ms, past the timeout. Ignoring it.".format(elapsed))
+            if self._renderer is not None:
+                self._renderer.stop()
+            return
+        if error is not None:
+            self._logger.error("Failed to initialize! " + error)
+            if self._enabled:
                 self._logger.info("Disabling OctOLED!")
                 self._enabled = False
                 self._settings.set(["enabled"], False)
+            return
+        self._logger.info("Initialization complete in {0:.0f} ms.".format(elapsed))
+        # The display was set up from the settings of on_after_startup, apply any saved since
+        self.reload_settings()
+        # Draws anything that was submitted while starting up
+        self._update_queue.start()
+        self._update_suspension()
+        self._clock_timer = octoprint.util.RepeatedTimer(1.0, self._tick_clock, daemon=True)
+        self._clock_timer.start()
+
+    # Hand the displays to a worker process (see render_process.py) and wait for it to draw the first
+    # frame. May throw.
+    def start_renderer(self):
+        from .render_process import RenderProcess
+        started = time.monotonic()
+        self._current_text = None
+        renderer = RenderProcess(
+            lambda: self._config.as_dict(),
+            self.get_plugin_data_folder(),
+            self._logger,
+            self.queue_update,
+            self._preview.notify,
+            self._on_renderer_restart
+        )
+        renderer.start(self._config.init_timeout)
+        self._renderer = renderer
+        self._startup_timings.update(renderer.startup_timings)
+        self._startup_phase("render process", started)
+
+    # The init thread is stuck (e.g. in an I2C transfer). It can't be stopped, but nothing it does
+    # from now on reaches the display.
+    def _on_init_timeout(self, timeout):
+        with self._init_lock:
+            if self._init_state != "pending":
+                return
+            self._init_state = "timeout"
+        self._logger.error("Display initialization timed out after " + str(timeout) + " s, OctOLED is disabled until restart")
+        self._enabled = False
+
+    ##~~ ShutdownPlugin mixin
+    def on_shutdown(self):
+        if self._init_watchdog is not None:
+            self._init_watchdog.cancel()
+        if self._clock_timer is not None:
+            self._clock_timer.cancel()
+        if self._update_queue is not None:
+            self._update_queue.stop()
+        if self._render_loop is not None:
+            self._render_loop.stop()
+        if self._renderer is not None:
+            self._renderer.stop()
+        if self._preview is not None:
+            self._preview.stop()
 
     ##~~ SettingsPlugin mixin
     def get_settings_defaults(self):
@@ -334,10 +1248,50 @@ class OctOLEDPlugin(octoprint.plugin.SettingsPlugin,
                 enabled=True,
                 display_text="Hello world!",
                 display_font_size=14,
+                auto_fit=False,
                 display_width=128,
                 display_height=32,
                 rotate_180=False,
-                demo_anim=False
+                demo_anim=False,
+                scroll_mode="overflow",
+                scroll_speed=30,
+                scroll_fps=20,
+                scroll_hardware=True,
+                display_mode="text",
+                status_format="{progress}% Z{z}",
+                max_refresh_rate=5,
+                adaptive_refresh=True,
+                printing_refresh_rate=1,
+                idle_refresh_rate=0.2,
+                sleep_timeout=0,
+                # Max frames/sec of the live preview in the settings dialog, 0 turns it off
+                preview_rate=5,
+                # Seconds to wait for the display to initialize before giving up
+                init_timeout=10,
+                # Render and drive the displays from a separate process (needs a restart)
+                render_process=False,
+                # "ssd1306" for real panels, "virtual" for an in-memory display without any hardware (needs a restart)
+                display_backend="ssd1306",
+                # I2C address of the main display and its bus number (None for the board's default bus)
+                display_address="0x3C",
+                display_bus=None,
+                # I2C clock in Hz (needs a restart), max bytes per data write (0 = whole window in
+                # one write) and how often a failed write is retried, doubling the delay each time
+                i2c_frequency=400000,
+                i2c_chunk_size=0,
+                i2c_retries=2,
+                i2c_retry_backoff_ms=5,
+                # More displays: dict(name, address, bus, width, height, rotate_180, display_mode,
+                # display_text, status_format, widgets)
+                extra_displays=[],
+                # Status screen layout for display_mode "widgets", boxes are [x, y, width, height]
+                widgets=[
+                    dict(type="text", box=[0, 0, 128, 11], format="{file}", font_size=9),
+                    dict(type="progress", box=[0, 13, 96, 7]),
+                    dict(type="text", box=[98, 11, 30, 11], format="{progress}%", font_size=9, align="right"),
+                    dict(type="text", box=[0, 22, 64, 10], format="{tool0}/{bed}C", font_size=9),
+                    dict(type="text", box=[64, 22, 64, 10], format="{eta}", font_size=9, align="right")
+                ]
             )
 
     # Disable custom bindings (??)
@@ -401,10 +1355,16 @@ def __plugin_load__():
 
     global __plugin_hooks__
     __plugin_hooks__ = {
-        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.on_temperatures_received
     }
 
     global __plugin_helpers__
     __plugin_helpers__ = dict(
-        show_text=plugin.show_text
+        show_text=plugin.queue_text,
+        queue_update=plugin.queue_update,
+        push_frame=plugin.push_frame,
+        draw=plugin.draw,
+        play_sprite=plugin.play_sprite,
+        stop_sprite=plugin.stop_sprite
     )
@@ -0,0 +1,289 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import asyncio
+import math
+import threading
+import time
+
+from .timing import TimingStats
+
+
+##~~ Frame scheduler
+# Hands out fixed-rate frame deadlines. When a frame finishes after the next deadline has already
+# passed, the missed frames are dropped (counted) and the schedule jumps ahead instead of trying to
+# catch up, so a slow flush never snowballs into a backlog. With max_fps set, slots are skipped the same
+# way so frames are presented no more often than that: animations keep their speed and get choppier.
+class FrameScheduler(object):
+    def __init__(self, fps, max_fps=None):
+        self.fps = float(fps)
+        self.interval = 1.0 / self.fps
+        self.max_fps = max_fps
+        self.frames = 0
+        self.dropped_frames = 0
+        self.skipped_frames = 0
+        self.render_time = TimingStats()
+        self.flush_time = TimingStats()
+        self._next = None
+        # Achieved FPS is measured since the last (re)start so pauses don't drag it down
+        self._window_start = None
+        self._window_frames = 0
+
+    def start(self, now=None):
+        self.rebase(now)
+
+    # Restart the deadlines without counting the gap as dropped frames (e.g. after a pause)
+    def rebase(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._next = now
+        self._window_start = now
+        self._window_frames = 0
+
+    # Called once a frame has been presented. Returns the number of frame slots the animation should
+    # advance by (1 + dropped and skipped frames). `duration` overrides the frame interval for this frame.
+    def advance(self, now=None, duration=None):
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        self._window_frames += 1
+        self._next += self.interval if duration is None else duration
+        missed = 0
+        if now > self._next:
+            missed = int((now - self._next) // self.interval) + 1
+            self.dropped_frames += missed
+            self._next += missed * self.interval
+        skipped = 0
+        max_fps = self.max_fps
+        if max_fps and max_fps < self.fps and self._next < now + 1.0 / max_fps:
+            skipped = int(math.ceil((now + 1.0 / max_fps - self._next) / self.interval))
+            self.skipped_frames += skipped
+            self._next += skipped * self.interval
+        return missed + skipped + 1
+
+    # Seconds to wait until the next frame slot starts
+    def wait_time(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._next - now)
+
+    def achieved_fps(self, now=None):
+        if self._window_start is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._window_start
+        return self._window_frames / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        return dict(
+            target_fps=self.fps,
+            max_fps=self.max_fps,
+            fps=self.achieved_fps(),
+            frames=self.frames,
+            dropped_frames=self.dropped_frames,
+            skipped_frames=self.skipped_frames,
+            render=self.render_time.as_dict(),
+            flush=self.flush_time.as_dict()
+        )
+
+
+##~~ Frame context
+# Passed to coroutine animations. An animation draws a frame, then awaits present(), which flushes
+# it, waits for the next frame deadline (or for the animation to be resumed) and returns how many
+# frame slots elapsed. Animations with frames of different lengths pass each frame's duration.
+class FrameContext(object):
+    def __init__(self, animation, scheduler, flush):
+        self.animation = animation
+        self.scheduler = scheduler
+        self._flush = flush
+        self._frame_start = None
+
+    async def present(self, duration=None):
+        now = time.monotonic()
+        if self._frame_start is not None:
+            self.scheduler.render_time.add(now - self._frame_start)
+        self._flush()
+        self.scheduler.flush_time.add(time.monotonic() - now)
+
+        steps = self.scheduler.advance(duration=duration)
+        await asyncio.sleep(self.scheduler.wait_time())
+        if not self.animation._resumed.is_set():
+            await self.animation._resumed.wait()
+            self.scheduler.rebase()
+        self._frame_start = time.monotonic()
+        return steps
+
+
+# Drive a frame generator: each iteration draws one frame, and the generator is sent the number of
+# frame slots that elapsed since its previous frame
+async def _run_frame_generator(frames, ctx):
+    steps = None
+    try:
+        while True:
+            try:
+                frames.send(steps)
+            except StopIteration:
+                return
+            steps = await ctx.present()
+    finally:
+        frames.close()
+
+
+##~~ Animation handle
+# Returned by RenderLoop.play(). All methods are safe to call from any thread.
+class Animation(object):
+    def __init__(self, render_loop, name, fps, max_fps=None):
+        self.name = name
+        self.scheduler = FrameScheduler(fps, max_fps)
+        self._render_loop = render_loop
+        self._future = None
+        self._finished = threading.Event()
+        self._paused = False
+        # Created on the render thread once the animation starts
+        self._resumed = None
+
+    @property
+    def done(self):
+        return self._future is None or self._future.done()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def pause(self):
+        self._paused = True
+        self._render_loop.call_soon(self._sync_paused)
+
+    def resume(self):
+        self._paused = False
+        self._render_loop.call_soon(self._sync_paused)
+
+    # Runs on the render thread
+    def _sync_paused(self):
+        if self._resumed is None:
+            return
+        if self._paused:
+            self._resumed.clear()
+        else:
+            self._resumed.set()
+
+    def cancel(self):
+        if self._future is not None:
+            self._future.cancel()
+
+    # Call fn(animation) once the animation is done (finished, cancelled or failed), on the render thread
+    # or right away if it already is
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda future: fn(self))
+
+    # Block until the animation has stopped drawing (or the timeout expires)
+    def wait(self, timeout=None):
+        if self._future is None:
+            return True
+        return self._finished.wait(timeout)
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        stats.update(name=self.name, running=not self.done, paused=self.paused)
+        return stats
+
+
+##~~ Render loop
+# Runs an asyncio event loop on a dedicated thread so animations never block OctoPrint's threads.
+# Only one animation plays at a time; starting a new one cancels the previous one.
+class RenderLoop(object):
+    def __init__(self, logger):
+        self._logger = logger
+        self._loop = None
+        self._thread = None
+        self._current = None
+        self._lock = threading.Lock()
+        # Cap on the frame rate of every animation, None for none
+        self._max_fps = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def current(self):
+        return self._current
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, name="OctOLED-render", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=2.0):
+        with self._lock:
+            if not self.running:
+                return
+            if self._current is not None:
+                self._current.cancel()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._loop.close()
+
+    def call_soon(self, callback, *args):
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    # Present frames of the current and later animations no more often than max_fps (None = as often as
+    # they ask for). Takes effect from the next frame on.
+    def set_max_fps(self, max_fps):
+        self._max_fps = max_fps
+        current = self._current
+        if current is not None:
+            current.scheduler.max_fps = max_fps
+
+    # Start playing an animation. `animation` is either a frame generator (draws one frame per
+    # iteration) or a coroutine function taking a FrameContext. `flush` pushes the drawn frame to
+    # the display and is called on the render thread.
+    def play(self, animation, fps, flush, name="animation"):
+        self.start()
+        if self._current is not None:
+            self._current.cancel()
+        handle = Animation(self, name, fps, self._max_fps)
+        handle._future = asyncio.run_coroutine_threadsafe(self._play(handle, animation, flush), self._loop)
+        self._current = handle
+        return handle
+
+    async def _play(self, handle, animation, flush):
+        handle._resumed = asyncio.Event()
+        handle._resumed.set()
+        handle._sync_paused()
+        ctx = FrameContext(handle, handle.scheduler, flush)
+        handle.scheduler.start()
+        ctx._frame_start = time.monotonic()
+        self._logger.info("Animation started: " + handle.name)
+        try:
+            if asyncio.iscoroutinefunction(animation):
+                await animation(ctx)
+            else:
+                await _run_frame_generator(animation, ctx)
+        except asyncio.CancelledError:
+            self._logger.info("Animation cancelled: " + handle.name)
+            raise
+        except Exception as err:
+            self._logger.error("Animation " + handle.name + " failed: " + str(err))
+            raise
+        else:
+            self._logger.info("Animation finished: " + handle.name)
+        finally:
+            handle._finished.set()
+
+    def stats(self):
+        if self._current is None:
+            return None
+        return self._current.stats()
@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+##~~ Display backends
+# A backend knows how to open an I2C bus and create the driver for a panel on it. The hardware
+# libraries are only imported by the backend that needs them, so OctOLED loads (and the virtual
+# backend works) on machines without Blinka or the SSD1306 driver.
+
+
+class DisplayBackend(object):
+    name = None
+
+    # bus_id is None for the board's default bus. May throw.
+    def open_bus(self, bus_id, frequency):
+        raise NotImplementedError
+
+    # Returns an object with the adafruit_ssd1306.SSD1306_I2C interface. May throw.
+    def create_driver(self, i2c, width, height, address):
+        raise NotImplementedError
+
+
+# Real panels through Adafruit Blinka and adafruit_ssd1306
+class SSD1306Backend(DisplayBackend):
+    name = "ssd1306"
+
+    # Bus speed is applied when a bus is opened. On Linux the kernel driver has the final say
+    # (e.g. dtparam=i2c_arm_baudrate=400000 on a Raspberry Pi).
+    def open_bus(self, bus_id, frequency):
+        if bus_id is None:
+            import board
+            import busio
+            return busio.I2C(board.SCL, board.SDA, frequency=frequency)
+        # Buses other than the board's default one need Adafruit-Extended-Bus
+        from adafruit_extended_bus import ExtendedI2C
+        return ExtendedI2C(int(bus_id), frequency=frequency)
+
+    def create_driver(self, i2c, width, height, address):
+        import adafruit_ssd1306
+        return adafruit_ssd1306.SSD1306_I2C(width, height, i2c, addr=address)
+
+
+# In-memory panels (see virtual.py). Every bus id gets its own simulated bus.
+class VirtualBackend(DisplayBackend):
+    name = "virtual"
+
+    def __init__(self, simulate_timing=True):
+        self.simulate_timing = simulate_timing
+
+    def open_bus(self, bus_id, frequency):
+        from .virtual import VirtualI2C
+        return VirtualI2C(frequency=frequency, simulate_timing=self.simulate_timing)
+
+    def create_driver(self, i2c, width, height, address):
+        from .virtual import VirtualSSD1306
+        return VirtualSSD1306(width, height, i2c, addr=address)
+
+
+BACKENDS = {
+    SSD1306Backend.name: SSD1306Backend,
+    VirtualBackend.name: VirtualBackend
+}
+
+
+def create_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError("Unknown display backend: " + str(name))
+    return BACKENDS[name](**options)
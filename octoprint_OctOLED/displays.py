@@ -0,0 +1,265 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from PIL import Image, ImageDraw
+
+from .framebuffer import DISPLAY_OFF, DISPLAY_ON, FrameDiffer, can_pack, pack_image, write_frame
+from .hwscroll import DEACTIVATE_SCROLL, scroll_commands
+from .transport import I2CTransport
+
+# Window used for refresh rates and bus utilization
+STATS_WINDOW = 5.0
+
+
+# Events per second over the last STATS_WINDOW seconds
+class RateMeter(object):
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.count = 0
+        self._events = deque()
+
+    def add(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.count += 1
+        self._events.append(now)
+        self._trim(now)
+
+    def _trim(self, now):
+        while self._events and self._events[0] < now - self.window:
+            self._events.popleft()
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._trim(now)
+        return len(self._events) / self.window
+
+
+##~~ Bus arbiter
+# One per I2C bus. Every display flushes a whole frame (all of its dirty windows) inside a single
+# transfer() block, and blocks are granted in the order they were requested, so a panel that
+# refreshes constantly can't keep another panel on the same bus waiting.
+class BusArbiter(object):
+    def __init__(self, bus_id, i2c):
+        self.bus_id = bus_id
+        self.i2c = i2c
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._started = time.monotonic()
+        # (end time, busy seconds) of recent transfers, for utilization over the stats window
+        self._recent = deque()
+        self.transfers = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.clients = dict()
+
+    @contextmanager
+    def transfer(self, client):
+        requested = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._cond.wait()
+        acquired = time.monotonic()
+        result = dict(bytes=0)
+        try:
+            yield result
+        finally:
+            done = time.monotonic()
+            with self._cond:
+                self._serving += 1
+                self._cond.notify_all()
+                self._record(client, acquired - requested, done - acquired, result["bytes"], done)
+
+    def _record(self, client, wait, busy, sent, now):
+        self.transfers += 1
+        self.bytes += sent
+        self.busy_time += busy
+        self._recent.append((now, busy))
+        while self._recent and self._recent[0][0] < now - STATS_WINDOW:
+            self._recent.popleft()
+        stats = self.clients.setdefault(client, dict(transfers=0, bytes=0, busy_time=0.0, wait_time=0.0, max_wait=0.0))
+        stats["transfers"] += 1
+        stats["bytes"] += sent
+        stats["busy_time"] += busy
+        stats["wait_time"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            window = min(STATS_WINDOW, now - self._started)
+            recent_busy = sum(busy for end, busy in self._recent if end >= now - STATS_WINDOW)
+            clients = dict()
+            for client, stats in self.clients.items():
+                clients[client] = dict(
+                    transfers=stats["transfers"],
+                    bytes=stats["bytes"],
+                    busy_ms=stats["busy_time"] * 1000,
+                    avg_wait_ms=(stats["wait_time"] / stats["transfers"]) * 1000 if stats["transfers"] else 0,
+                    max_wait_ms=stats["max_wait"] * 1000
+                )
+            return dict(
+                bus=self.bus_id,
+                transfers=self.transfers,
+                bytes=self.bytes,
+                busy_ms=self.busy_time * 1000,
+                utilization=(recent_busy / window) if window > 0 else 0,
+                queued=self._next_ticket - self._serving,
+                clients=clients
+            )
+
+
+# Opens each I2C bus once and hands out its arbiter. open_bus(bus_id) creates the I2C object.
+class BusManager(object):
+    def __init__(self, open_bus):
+        self._open_bus = open_bus
+        self._buses = dict()
+        self._lock = threading.Lock()
+
+    def get(self, bus_id):
+        with self._lock:
+            arbiter = self._buses.get(bus_id)
+            if arbiter is None:
+                arbiter = BusArbiter(bus_id, self._open_bus(bus_id))
+                self._buses[bus_id] = arbiter
+            return arbiter
+
+    def stats(self):
+        with self._lock:
+            buses = list(self._buses.values())
+        return [arbiter.stats() for arbiter in buses]
+
+
+##~~ Display
+# One panel: its driver, its own image buffer and frame differ, and the bus it lives on
+class Display(object):
+    # create_driver(i2c) builds the driver object, it is called while holding the bus.
+    # transport_options are passed on to I2CTransport (chunk_size, retries, backoff).
+    def __init__(self, name, arbiter, create_driver, rotation=0, lock=None, transport_options=None):
+        self.name = name
+        self.arbiter = arbiter
+        self.lock = threading.RLock() if lock is None else lock
+        self.refresh = RateMeter()
+        self.compositor = None
+        self.config = dict()
+        with arbiter.transfer(name):
+            self.oled = create_driver(arbiter.i2c)
+        self.oled.rotation = rotation
+        self.transport = I2CTransport(self.oled, **(transport_options or dict()))
+        self.differ = FrameDiffer(self.oled.width, self.oled.height)
+        # Frames per step of the running hardware scroll, None if the controller isn't scrolling
+        self.hw_scroll = None
+        self.powered = True
+        # Make sure to create image with mode '1' for 1-bit color.
+        self.image = Image.new("1", (self.oled.width, self.oled.height))
+        self.draw = ImageDraw.Draw(self.image)
+
+    def clear(self):
+        with self.lock:
+            self.draw.rectangle((0, 0, self.oled.width, self.oled.height), outline=0, fill=0)
+
+    def draw_centered_text(self, atlas, text):
+        with self.lock:
+            self.clear()
+            (font_width, font_height) = atlas.getsize(text)
+            atlas.draw_text(
+                self.draw,
+                (self.oled.width // 2 - font_width // 2, self.oled.height // 2 - font_height // 2),
+                text,
+                fill=255,
+            )
+
+    # Draw a layout from layout.TextFitter with the atlas for its size
+    def draw_layout(self, atlas, layout):
+        with self.lock:
+            self.clear()
+            for text, x, y in layout.lines:
+                atlas.draw_text(self.draw, (x, y), text, fill=255)
+
+    def set_rotation(self, rotation):
+        with self.lock:
+            self.oled.rotation = rotation
+
+    # Copy the image into the driver's buffer
+    def pack(self):
+        with self.lock:
+            if can_pack(self.oled.rotation):
+                pack_image(self.image, self.oled.buffer, self.oled.width, self.oled.height, self.oled.rotation)
+            else:
+                self.oled.image(self.image)
+
+    # Put a packed frame (see framebuffer.write_frame) straight into the driver's buffer. The image is
+    # left alone, so the next pack() brings back whatever was drawn there.
+    def write_frame(self, data, box=None):
+        with self.lock:
+            write_frame(data, self.oled.buffer, self.oled.width, self.oled.height, box)
+
+    # Send the changed parts of the driver's buffer (see FrameDiffer.flush for rects and base). May throw.
+    def flush(self, rects=None, base=None):
+        with self.lock:
+            with self.arbiter.transfer(self.name) as transfer:
+                start = time.monotonic()
+                # Writing RAM while the controller scrolls garbles the panel
+                transfer["bytes"] = self._stop_scroll()
+                transfer["bytes"] += self.differ.flush(self.transport, rects, base)
+                self.transport.stats.record_flush(time.monotonic() - start, transfer["bytes"])
+            self.refresh.add()
+            return transfer["bytes"]
+
+    # Switch the panel off or back on, it keeps what it shows meanwhile. May throw.
+    def set_power(self, on):
+        with self.lock:
+            with self.arbiter.transfer(self.name) as transfer:
+                transfer["bytes"] = self.transport.write_commands([DISPLAY_ON if on else DISPLAY_OFF])
+            self.powered = on
+
+    # Let the controller scroll the whole panel left by itself, one pixel every `frames` frames (see
+    # hwscroll.py), starting from what was flushed last. It keeps going until stop_scroll() or the
+    # next flush. May throw.
+    def start_scroll(self, frames):
+        with self.lock:
+            # Turned around, the panel's columns run right to left
+            commands = scroll_commands(frames, 0, self.oled.height // 8 - 1, left=self.oled.rotation != 2)
+            with self.arbiter.transfer(self.name) as transfer:
+                transfer["bytes"] = self.transport.write_commands(commands)
+            self.hw_scroll = frames
+
+    # May throw
+    def stop_scroll(self):
+        with self.lock:
+            if self.hw_scroll is None:
+                return
+            with self.arbiter.transfer(self.name) as transfer:
+                transfer["bytes"] = self._stop_scroll()
+
+    # The controller leaves its RAM shifted by however far it scrolled, so the next flush sends
+    # everything. Call while holding the bus.
+    def _stop_scroll(self):
+        if self.hw_scroll is None:
+            return 0
+        sent = self.transport.write_commands([DEACTIVATE_SCROLL])
+        self.hw_scroll = None
+        self.differ.invalidate()
+        return sent
+
+    def stats(self):
+        return dict(
+            name=self.name,
+            bus=self.arbiter.bus_id,
+            address=hex(self.oled.addr) if hasattr(self.oled, "addr") else None,
+            width=self.oled.width,
+            height=self.oled.height,
+            flushes=self.refresh.count,
+            refresh_rate=self.refresh.rate(),
+            powered=self.powered,
+            hardware_scroll=self.hw_scroll,
+            frames=self.differ.stats.as_dict(),
+            transport=self.transport.stats.as_dict()
+        )
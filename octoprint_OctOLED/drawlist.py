@@ -0,0 +1,200 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import base64
+import binascii
+
+from PIL import Image, ImageChops, ImageDraw
+
+##~~ Display lists
+# A batch of drawing operations, each a dict with an "op" key. Coordinates are pixels from the top
+# left, boxes are [x, y, width, height] and "color" is 1 (lit, the default) or 0:
+#
+#   clear     color (0)                                       fill the whole display
+#   text      x, y, text, size (display font), width + align ("left", "center", "right")
+#   rect      box, fill (false)
+#   line      points [x0, y0, x1, y1, ...], width (1)
+#   bitmap    x, y, width, height, data                       rows of packed bits, MSB first, each row
+#                                                             padded to a whole byte; base64 or bytes
+#   progress  box, value (0-100)                              bar drawn like the progress widget
+#   invert    box (whole display)                             flip every pixel in the box
+#
+# compile_display_list() checks everything and resolves fonts up front, so a bad batch is rejected
+# before anything is drawn and the drawing itself (render()) can't fail halfway.
+
+ALIGNMENTS = ("left", "center", "right")
+# Largest batch accepted
+MAX_OPERATIONS = 256
+# Text sizes accepted (every size gets its own glyph atlas)
+MIN_FONT_SIZE = 4
+MAX_FONT_SIZE = 64
+
+
+def _int(op, key, default=None):
+    value = op.get(key, default)
+    if value is None:
+        raise ValueError("missing " + key)
+    return int(value)
+
+
+def _color(op, default=1):
+    color = int(op.get("color", default))
+    if color not in (0, 1):
+        raise ValueError("color must be 0 or 1")
+    return 255 if color else 0
+
+
+def _box(op, width, height, key="box", required=True):
+    box = op.get(key)
+    if box is None:
+        if required:
+            raise ValueError("missing " + key)
+        return 0, 0, width, height
+    if len(box) != 4:
+        raise ValueError(key + " must be [x, y, width, height]")
+    x, y, w, h = [int(v) for v in box]
+    if w <= 0 or h <= 0:
+        raise ValueError(key + " must have a positive width and height")
+    return x, y, w, h
+
+
+##~~ Operations
+# Each one returns (draw function, arguments); draw functions are called as fn(image, draw, *args)
+
+def _clear(op, width, height, get_atlas):
+    return _draw_rect, ((0, 0, width - 1, height - 1), _color(op, 0), _color(op, 0))
+
+
+def _text(op, width, height, get_atlas):
+    text = op.get("text")
+    if text is None:
+        raise ValueError("missing text")
+    text = str(text)
+    x, y = _int(op, "x"), _int(op, "y")
+    align = op.get("align", "left")
+    if align not in ALIGNMENTS:
+        raise ValueError("align must be one of " + ", ".join(ALIGNMENTS))
+    size = op.get("size")
+    if size is not None:
+        size = int(size)
+        if not MIN_FONT_SIZE <= size <= MAX_FONT_SIZE:
+            raise ValueError("size must be between {0} and {1}".format(MIN_FONT_SIZE, MAX_FONT_SIZE))
+    atlas = get_atlas(size)
+    if align != "left":
+        text_width = atlas.getsize(text)[0]
+        span = _int(op, "width")
+        x += (span - text_width) // 2 if align == "center" else span - text_width
+    return _draw_text, (atlas, (x, y), text, _color(op))
+
+
+def _rect(op, width, height, get_atlas):
+    x, y, w, h = _box(op, width, height)
+    color = _color(op)
+    return _draw_rect, ((x, y, x + w - 1, y + h - 1), color, color if op.get("fill", False) else None)
+
+
+def _line(op, width, height, get_atlas):
+    points = [int(v) for v in op.get("points") or []]
+    if len(points) < 4 or len(points) % 2:
+        raise ValueError("points must be [x0, y0, x1, y1, ...]")
+    line_width = _int(op, "width", 1)
+    if line_width < 1:
+        raise ValueError("width must be at least 1")
+    return _draw_line, (points, _color(op), line_width)
+
+
+def _bitmap(op, width, height, get_atlas):
+    x, y = _int(op, "x"), _int(op, "y")
+    w, h = _int(op, "width"), _int(op, "height")
+    if w <= 0 or h <= 0:
+        raise ValueError("width and height must be positive")
+    data = op.get("data")
+    if data is None:
+        raise ValueError("missing data")
+    if isinstance(data, str):
+        try:
+            data = base64.b64decode(data, validate=True)
+        except binascii.Error as err:
+            raise ValueError("data: " + str(err))
+    expected = (w + 7) // 8 * h
+    if len(data) != expected:
+        raise ValueError("data must be {0} bytes for {1}x{2}, got {3}".format(expected, w, h, len(data)))
+    return _draw_bitmap, ((x, y), Image.frombytes("1", (w, h), bytes(data)), _color(op))
+
+
+def _progress(op, width, height, get_atlas):
+    x, y, w, h = _box(op, width, height)
+    value = max(0.0, min(100.0, float(op.get("value", 0))))
+    return _draw_progress, ((x, y, w, h), int(value * (w - 2) / 100))
+
+
+def _invert(op, width, height, get_atlas):
+    x, y, w, h = _box(op, width, height, required=False)
+    # Clip to the display, crop() would pad with black
+    box = (max(0, x), max(0, y), min(width, x + w), min(height, y + h))
+    return _draw_invert, (box,)
+
+
+def _draw_rect(image, draw, box, outline, fill):
+    draw.rectangle(box, outline=outline, fill=fill)
+
+
+def _draw_text(image, draw, atlas, xy, text, fill):
+    atlas.draw_text(draw, xy, text, fill=fill)
+
+
+def _draw_line(image, draw, points, fill, width):
+    draw.line(points, fill=fill, width=width)
+
+
+def _draw_bitmap(image, draw, xy, bitmap, fill):
+    draw.bitmap(xy, bitmap, fill=fill)
+
+
+def _draw_progress(image, draw, box, filled):
+    x, y, w, h = box
+    draw.rectangle((x, y, x + w - 1, y + h - 1), outline=255, fill=0)
+    if filled > 0:
+        draw.rectangle((x + 1, y + 1, x + filled, y + h - 2), outline=255, fill=255)
+
+
+def _draw_invert(image, draw, box):
+    if box[2] > box[0] and box[3] > box[1]:
+        image.paste(ImageChops.invert(image.crop(box)), box[:2])
+
+
+OPERATIONS = {
+    "clear": _clear,
+    "text": _text,
+    "rect": _rect,
+    "line": _line,
+    "bitmap": _bitmap,
+    "progress": _progress,
+    "invert": _invert
+}
+
+
+# Validate `ops` for a width x height display. get_atlas(size) returns the glyph atlas for a font size,
+# None meaning the display font. Raises ValueError naming the first bad operation.
+def compile_display_list(ops, width, height, get_atlas):
+    if not isinstance(ops, (list, tuple)):
+        raise ValueError("ops must be a list")
+    if len(ops) > MAX_OPERATIONS:
+        raise ValueError("At most {0} operations per batch, got {1}".format(MAX_OPERATIONS, len(ops)))
+    compiled = []
+    for index, op in enumerate(ops):
+        name = op.get("op") if isinstance(op, dict) else None
+        if name not in OPERATIONS:
+            raise ValueError("Operation {0}: unknown op {1!r}".format(index, name))
+        try:
+            compiled.append(OPERATIONS[name](op, width, height, get_atlas))
+        except (TypeError, ValueError) as err:
+            raise ValueError("Operation {0} ({1}): {2}".format(index, name, err))
+    return compiled
+
+
+# Draw a compiled display list into `image` in one pass
+def render(compiled, image):
+    draw = ImageDraw.Draw(image)
+    for fn, args in compiled:
+        fn(image, draw, *args)
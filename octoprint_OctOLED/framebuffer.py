@@ -0,0 +1,249 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from PIL import Image
+
+##~~ SSD1306 framebuffer helpers
+# The SSD1306 stores pixels in "pages": each page is 8 rows tall and every byte in a page is one
+# column of 8 vertical pixels (LSB at the top). The I2C driver keeps this layout in oled.buffer,
+# with one leading control byte (0x40) so the whole buffer can be sent in a single transaction.
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+DISPLAY_OFF = 0xAE
+DISPLAY_ON = 0xAF
+
+# Control bytes that precede a stream of commands (Co=0, D/C=0) or of display data (Co=0, D/C=1)
+CMD_CONTROL_BYTE = 0x00
+DATA_CONTROL_BYTE = 0x40
+# Setting the column and page window takes 6 commands, sent together in one write by the transport
+WINDOW_CMD_BYTES = 1 + 6
+
+
+##~~ Image packing
+# Converts a mode "1" PIL image straight into the page layout, replacing the driver's per-pixel
+# image() loop. Turning the image 90 degrees clockwise makes every display column a row of the
+# transposed image, and tobytes() packs each row MSB first, which gives the column's pages from the
+# bottom page up. The pages only need to be picked out of that in reverse order.
+
+# Driver rotation -> transpose that turns the image into "one row per display column" form
+_PACK_TRANSPOSE = {
+    0: Image.ROTATE_270,
+    2: Image.ROTATE_90
+}
+
+
+def can_pack(rotation):
+    return rotation in _PACK_TRANSPOSE
+
+
+# Pack `image` into `buffer` (the driver's buffer, with its leading control byte at `offset` - 1)
+def pack_image(image, buffer, width, height, rotation=0, offset=1):
+    if image.mode != "1":
+        raise ValueError("Image must be in mode 1.")
+    if image.size != (width, height):
+        raise ValueError("Image must be same dimensions as display ({0}x{1}).".format(width, height))
+    pages = height // 8
+    columns = memoryview(image.transpose(_PACK_TRANSPOSE[rotation]).tobytes())
+    for page in range(pages):
+        start = offset + page * width
+        buffer[start:start + width] = columns[pages - 1 - page::pages]
+
+
+# Copy a packed 1-bit frame in the SSD1306's own layout (page by page, one byte per column with the
+# top pixel in the LSB) into `buffer`. `box` = (x, y, width, height) limits the copy to the region
+# that changed, y and height must be multiples of 8. `data` holds either the whole frame or only the
+# box, page by page.
+def write_frame(data, buffer, width, height, box=None, offset=1):
+    pages = height // 8
+    if box is None:
+        x, page0, span, count = 0, 0, width, pages
+    else:
+        x, y, w, h = [int(v) for v in box]
+        if y % 8 or h % 8:
+            raise ValueError("Box y and height must be multiples of 8.")
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+            raise ValueError("Box must be inside the display ({0}x{1}).".format(width, height))
+        page0, span, count = y // 8, w, h // 8
+
+    data = memoryview(data)
+    if len(data) == width * pages:
+        # Whole frame, copy the box out of it
+        stride, src = width, page0 * width + x
+    elif len(data) == span * count:
+        stride, src = span, 0
+    elif box is None:
+        raise ValueError("Frame must be {0} bytes, got {1}.".format(width * pages, len(data)))
+    else:
+        raise ValueError("Frame must be {0} bytes (whole display) or {1} bytes (box), got {2}.".format(width * pages, span * count, len(data)))
+
+    dst = offset + page0 * width + x
+    if span == width:
+        # Whole pages are contiguous on both sides
+        buffer[dst:dst + count * width] = data[src:src + count * width]
+        return
+    for page in range(count):
+        buffer[dst:dst + span] = data[src:src + span]
+        dst += width
+        src += stride
+
+
+# Counters for the bytes actually pushed over the bus compared to what full-frame updates would cost
+class FrameStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.full_frames = 0
+        self.partial_frames = 0
+        self.unchanged_frames = 0
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.full_frame_bytes = 0
+        self.last_frame_bytes = 0
+
+    def record(self, sent, full_cost, transfers, full=False):
+        self.frames += 1
+        if sent == 0:
+            self.unchanged_frames += 1
+        elif full:
+            self.full_frames += 1
+        else:
+            self.partial_frames += 1
+        self.transfers += transfers
+        self.bytes_sent += sent
+        self.full_frame_bytes += full_cost
+        self.last_frame_bytes = sent
+
+    def as_dict(self):
+        saved = self.full_frame_bytes - self.bytes_sent
+        return dict(
+            frames=self.frames,
+            full_frames=self.full_frames,
+            partial_frames=self.partial_frames,
+            unchanged_frames=self.unchanged_frames,
+            transfers=self.transfers,
+            bytes_sent=self.bytes_sent,
+            bytes_per_frame=(self.bytes_sent / self.frames) if self.frames else 0,
+            last_frame_bytes=self.last_frame_bytes,
+            bytes_saved=saved,
+            savings=(saved / self.full_frame_bytes) if self.full_frame_bytes else 0
+        )
+
+
+# Keeps a copy of the last frame sent to the display and only pushes the pages/columns that changed
+class FrameDiffer(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        # Displays narrower than the controller's 128 columns are centered
+        self.col_offset = (128 - width) // 2 if width != 128 else 0
+        self.stats = FrameStats()
+        self._last = None
+
+    # Force the next flush to send the whole frame (e.g. after the panel was reset or cleared)
+    def invalidate(self):
+        self._last = None
+
+    # Take `frame` as what the panel shows (e.g. to plan the update from one known frame to another)
+    def assume(self, frame):
+        self._last = bytes(frame)
+
+    def full_frame_cost(self):
+        return WINDOW_CMD_BYTES + 1 + self.pages * self.width
+
+    # Bytes on the bus needed to update the rectangle (page0, page1, col0, col1), inclusive
+    @staticmethod
+    def window_cost(rect):
+        p0, p1, c0, c1 = rect
+        return WINDOW_CMD_BYTES + 1 + (p1 - p0 + 1) * (c1 - c0 + 1)
+
+    # Changed column span per page as a list of (page, col0, col1), inclusive
+    def dirty_spans(self, frame):
+        if self._last is None:
+            return [(page, 0, self.width - 1) for page in range(self.pages)]
+        spans = []
+        width = self.width
+        last = self._last
+        for page in range(self.pages):
+            start = page * width
+            end = start + width
+            if frame[start:end] == last[start:end]:
+                continue
+            c0 = start
+            while frame[c0] == last[c0]:
+                c0 += 1
+            c1 = end - 1
+            while frame[c1] == last[c1]:
+                c1 -= 1
+            spans.append((page, c0 - start, c1 - start))
+        return spans
+
+    # Group the dirty spans into rectangles, merging neighbours whenever that is cheaper than
+    # addressing them separately
+    def dirty_rects(self, frame):
+        rects = []
+        for page, c0, c1 in self.dirty_spans(frame):
+            span = (page, page, c0, c1)
+            if rects:
+                cur = rects[-1]
+                merged = (cur[0], page, min(cur[2], c0), max(cur[3], c1))
+                if self.window_cost(merged) <= self.window_cost(cur) + self.window_cost(span):
+                    rects[-1] = merged
+                    continue
+            rects.append(span)
+        return rects
+
+    # Windows to send for `frame` as ([(page0, page1, col0, col1)], full frame)
+    def plan(self, frame):
+        rects = self.dirty_rects(frame)
+        if sum(self.window_cost(rect) for rect in rects) >= self.full_frame_cost():
+            return [(0, self.pages - 1, 0, self.width - 1)], True
+        return rects, False
+
+    # Send the driver's framebuffer to the panel through `transport` (see transport.I2CTransport).
+    # `rects` can be given if they are already known (e.g. precompiled sprites); they are the changes
+    # from frame `base` and only used if that is what the panel shows. Returns the number of bytes
+    # written.
+    def flush(self, transport, rects=None, base=None):
+        full_cost = self.full_frame_cost()
+        # Page addressing mode writes page by page in the driver, just let it do the work
+        if transport.page_addressing:
+            transport.show()
+            self._last = None
+            self.stats.record(full_cost, full_cost, 1, full=True)
+            return full_cost
+
+        frame = transport.frame
+        if rects is not None and base is not None and self._last is not None and self._last == base:
+            full = rects == [(0, self.pages - 1, 0, self.width - 1)]
+        else:
+            rects, full = self.plan(frame)
+        try:
+            sent = 0
+            for rect in rects:
+                sent += self._write_window(transport, frame, rect)
+        except Exception:
+            # We don't know what made it to the panel, resend everything next time
+            self._last = None
+            raise
+        self._last = bytes(frame)
+        self.stats.record(sent, full_cost, len(rects), full=full)
+        return sent
+
+    def _write_window(self, transport, frame, rect):
+        p0, p1, c0, c1 = rect
+        span = c1 - c0 + 1
+        if span == self.width:
+            # Whole pages are contiguous in the buffer
+            data = frame[p0 * self.width:(p1 + 1) * self.width]
+        else:
+            data = bytearray((p1 - p0 + 1) * span)
+            pos = 0
+            for page in range(p0, p1 + 1):
+                start = page * self.width + c0
+                data[pos:pos + span] = frame[start:start + span]
+                pos += span
+        return transport.write_window(c0 + self.col_offset, c1 + self.col_offset, p0, p1, data)
@@ -0,0 +1,152 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+# Glyphs rasterized up front when an atlas is created; anything else is rasterized on first use
+PRELOAD_CHARS = "".join(chr(c) for c in range(0x20, 0x7F))
+
+
+# A rasterized glyph: 1-bit bitmap plus where to put it relative to the pen position
+class Glyph(object):
+    __slots__ = ("bitmap", "offset", "advance", "bottom")
+
+    def __init__(self, bitmap, offset, advance, bottom):
+        self.bitmap = bitmap
+        self.offset = offset
+        self.advance = advance
+        self.bottom = bottom
+
+
+##~~ Glyph atlas
+# Pre-rasterized glyphs for one (font face, size). Text is drawn by blitting the cached bitmaps
+# instead of going through FreeType for every string. Each glyph lands exactly where drawing it
+# on its own with ImageDraw.text() would put it.
+class GlyphAtlas(object):
+    def __init__(self, font, preload=PRELOAD_CHARS):
+        self.font = font
+        self._glyphs = {}
+        self._kerning = {}
+        for c in preload:
+            self.glyph(c)
+
+    def glyph(self, c):
+        glyph = self._glyphs.get(c)
+        if glyph is None:
+            glyph = self._rasterize(c)
+            self._glyphs[c] = glyph
+        return glyph
+
+    def _rasterize(self, c):
+        left, top, right, bottom = self.font.getbbox(c)
+        advance = self.font.getlength(c)
+        if right <= left or bottom <= top:
+            # Whitespace and other empty glyphs only move the pen
+            return Glyph(None, (0, 0), advance, 0)
+        bitmap = Image.new("1", (right - left, bottom - top))
+        ImageDraw.Draw(bitmap).text((-left, -top), c, font=self.font, fill=255)
+        return Glyph(bitmap, (left, top), advance, bottom)
+
+    # Horizontal adjustment between two glyphs, taken from FreeType's layout of the pair
+    def kerning(self, left, right):
+        pair = left + right
+        kern = self._kerning.get(pair)
+        if kern is None:
+            kern = self.font.getlength(pair) - self.glyph(left).advance - self.glyph(right).advance
+            self._kerning[pair] = kern
+        return kern
+
+    # Pen x position of every character in text, plus the final advance
+    def layout(self, text):
+        positions = []
+        x = 0.0
+        prev = None
+        for c in text:
+            if prev is not None:
+                x += self.kerning(prev, c)
+            positions.append(x)
+            x += self.glyph(c).advance
+            prev = c
+        return positions, x
+
+    # Same result as font.getsize(text): (advance width, bottom of the lowest glyph)
+    def getsize(self, text):
+        positions, width = self.layout(text)
+        height = 0
+        for c in text:
+            bottom = self.glyph(c).bottom
+            if bottom > height:
+                height = bottom
+        return int(round(width)), height
+
+    def draw_text(self, draw, xy, text, fill=255):
+        x0, y0 = xy
+        positions, unused = self.layout(text)
+        for x, c in zip(positions, text):
+            glyph = self._glyphs[c]
+            if glyph.bitmap is None:
+                continue
+            draw.bitmap((int(round(x0 + x)) + glyph.offset[0], int(y0) + glyph.offset[1]), glyph.bitmap, fill=fill)
+
+    def draw_char(self, draw, xy, c, fill=255):
+        glyph = self.glyph(c)
+        if glyph.bitmap is not None:
+            draw.bitmap((int(round(xy[0])) + glyph.offset[0], int(xy[1]) + glyph.offset[1]), glyph.bitmap, fill=fill)
+        return glyph.advance
+
+
+##~~ Glyph cache
+# Least recently used atlases keyed by (font face, size), so switching between a few font sizes in
+# settings doesn't rasterize everything again. The fonts are kept for good (one per size in use) and
+# shared with the text fitter, so an evicted atlas is rebuilt without reading the font file again.
+# Used from OctoPrint's threads and the render thread at once.
+class GlyphCache(object):
+    def __init__(self, max_atlases=4):
+        self.max_atlases = max_atlases
+        self.hits = 0
+        self.misses = 0
+        self._atlases = OrderedDict()
+        self._fonts = dict()
+        self._lock = threading.Lock()
+
+    # `load_font` is only called when the font isn't cached
+    def font(self, face, size, load_font):
+        with self._lock:
+            return self._font(face, size, load_font)
+
+    def _font(self, face, size, load_font):
+        key = (face, size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = load_font()
+            self._fonts[key] = font
+        return font
+
+    # `load_font` is only called when the font isn't cached. Sizes only a few strings are drawn at can
+    # pass preload="" to rasterize just the glyphs they use.
+    def get(self, face, size, load_font, preload=PRELOAD_CHARS):
+        key = (face, size)
+        with self._lock:
+            atlas = self._atlases.get(key)
+            if atlas is not None:
+                self.hits += 1
+                self._atlases.move_to_end(key)
+                return atlas
+            self.misses += 1
+            atlas = GlyphAtlas(self._font(face, size, load_font), preload)
+            self._atlases[key] = atlas
+            while len(self._atlases) > self.max_atlases:
+                self._atlases.popitem(last=False)
+            return atlas
+
+    def clear(self):
+        with self._lock:
+            self._atlases.clear()
+            self._fonts.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(atlases=len(self._atlases), fonts=len(self._fonts), hits=self.hits, misses=self.misses)
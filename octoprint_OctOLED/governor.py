@@ -0,0 +1,146 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+##~~ Refresh governor
+# Decides how often the display may be redrawn from what the printer is doing, so OctOLED stays out of
+# the way of the serial connection while a print runs:
+#
+#   first_layer  from PrintStarted until the second layer starts; the print is being watched
+#   printing     the rest of the print
+#   paused       someone is probably at the printer
+#   idle         no print running
+#   asleep       idle with no activity for sleep_after seconds; nothing is drawn (0 = never sleep)
+#
+# The second layer has started once two Z changes in a row are above the lowest Z seen since the print
+# started (a Z hop goes up and comes back down, start G-code moves are above the first layer).
+# on_change(state, rate) is called whenever the state changes.
+
+GOVERNOR_STATES = ("first_layer", "printing", "paused", "idle", "asleep")
+
+PRINT_END_EVENTS = {"PrintDone", "PrintFailed", "PrintCancelled"}
+
+# Z has to be this far above the first layer to count as the next layer (mm)
+LAYER_MARGIN = 0.01
+
+
+class RefreshGovernor(object):
+    # rates: state -> refreshes/sec
+    def __init__(self, on_change, rates, sleep_after=0.0):
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self.rates = dict(rates)
+        self.sleep_after = float(sleep_after)
+        self.state = "idle"
+        self.transitions = 0
+        self._since = time.monotonic()
+        self._last_activity = self._since
+        self._first_z = None
+        self._above = 0
+        self._first_layer_done = False
+        # Seconds spent in each state and at each rate, not counting the current stretch
+        self._state_time = dict((state, 0.0) for state in GOVERNOR_STATES)
+        self._rate_time = dict()
+
+    @property
+    def rate(self):
+        return self.rates[self.state]
+
+    def configure(self, rates=None, sleep_after=None):
+        with self._lock:
+            now = time.monotonic()
+            # Time so far counts towards the old rate
+            self._account(now)
+            if rates is not None:
+                self.rates = dict(rates)
+            if sleep_after is not None:
+                self.sleep_after = float(sleep_after)
+            state = self.state
+        self._on_change(state, self.rates[state])
+
+    # Printer events (see PRINT_STATE_EVENTS in the plugin) and ZChange
+    def on_event(self, event, payload):
+        if event == "ZChange":
+            self._on_z_change(payload.get("new"))
+            return
+        self.activity()
+        if event == "PrintStarted":
+            with self._lock:
+                self._first_z = None
+                self._above = 0
+                self._first_layer_done = False
+            self._set_state("first_layer")
+        elif event == "PrintPaused":
+            self._set_state("paused")
+        elif event == "PrintResumed":
+            self._set_state("printing" if self._first_layer_done else "first_layer")
+        elif event in PRINT_END_EVENTS:
+            self._set_state("idle")
+
+    def _on_z_change(self, z):
+        if z is None:
+            return
+        with self._lock:
+            if self.state != "first_layer":
+                return
+            if self._first_z is None or z < self._first_z:
+                self._first_z = z
+                self._above = 0
+                return
+            self._above = self._above + 1 if z > self._first_z + LAYER_MARGIN else 0
+            if self._above < 2:
+                return
+            self._first_layer_done = True
+        self._set_state("printing")
+
+    # Something the user will want to see (settings changed, text pushed, ...): wakes the display
+    def activity(self):
+        with self._lock:
+            self._last_activity = time.monotonic()
+            asleep = self.state == "asleep"
+        if asleep:
+            self._set_state("idle")
+
+    # Called periodically (every second) to put an idle display to sleep
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            sleepy = self.state == "idle" and self.sleep_after > 0 and now - self._last_activity >= self.sleep_after
+        if sleepy:
+            self._set_state("asleep")
+
+    def _set_state(self, state):
+        with self._lock:
+            if state == self.state:
+                return
+            self._account(time.monotonic())
+            self.state = state
+            self.transitions += 1
+            rate = self.rates[state]
+        self._on_change(state, rate)
+
+    # Move the time since the last change into the totals. Call while holding the lock.
+    def _account(self, now):
+        elapsed = now - self._since
+        self._state_time[self.state] += elapsed
+        rate = self.rates[self.state]
+        self._rate_time[rate] = self._rate_time.get(rate, 0.0) + elapsed
+        self._since = now
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._since
+            state_time = dict(self._state_time)
+            state_time[self.state] += elapsed
+            rate_time = dict(self._rate_time)
+            rate_time[self.rate] = rate_time.get(self.rate, 0.0) + elapsed
+            return dict(
+                state=self.state,
+                rate=self.rate,
+                transitions=self.transitions,
+                seconds_in_state=state_time,
+                # JSON object keys have to be strings
+                seconds_at_rate=dict((str(rate), seconds) for rate, seconds in rate_time.items())
+            )
@@ -0,0 +1,62 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+##~~ SSD1306 hardware scrolling
+# The controller can scroll a range of pages horizontally by itself, one pixel every N frames, until
+# told to stop. Content wraps around within the controller's 128 column RAM, so only text that fits
+# on a full-width panel can be scrolled this way. The step interval is picked from a small set of
+# frame counts, speeds that aren't close to one of them stay in software.
+
+DEACTIVATE_SCROLL = 0x2E
+ACTIVATE_SCROLL = 0x2F
+RIGHT_HORIZONTAL_SCROLL = 0x26
+LEFT_HORIZONTAL_SCROLL = 0x27
+
+# Frames per scroll step -> value of the interval parameter
+SCROLL_INTERVALS = {
+    2: 0b111,
+    3: 0b100,
+    4: 0b101,
+    5: 0b000,
+    25: 0b110,
+    64: 0b001,
+    128: 0b010,
+    256: 0b011
+}
+
+# Internal oscillator (~370 kHz with the 0xD5 0x80 clock setting the drivers use) and display clocks
+# per row (precharge phases 1 + 15 from 0xD9 0xF1, plus 50). The frame rate is oscillator / (clocks
+# per row * rows); it varies between panels by about 10%.
+OSCILLATOR_HZ = 370000
+CLOCKS_PER_ROW = 66
+# Largest relative speed error accepted for hardware scrolling
+SPEED_TOLERANCE = 0.25
+# Column RAM width of the controller
+RAM_COLUMNS = 128
+
+
+def panel_frame_rate(height):
+    return OSCILLATOR_HZ / float(CLOCKS_PER_ROW * height)
+
+
+# Hardware scroll closest to `speed` pixels/sec as (frames per step, actual speed), or None if no
+# interval is within SPEED_TOLERANCE
+def plan_scroll(speed, height):
+    if speed <= 0:
+        return None
+    frame_rate = panel_frame_rate(height)
+    frames = min(SCROLL_INTERVALS.keys(), key=lambda f: abs(frame_rate / f - speed))
+    actual = frame_rate / frames
+    if abs(actual - speed) / speed > SPEED_TOLERANCE:
+        return None
+    return frames, actual
+
+
+# Command bytes that (re)start a leftward scroll of pages page0..page1
+def scroll_commands(frames, page0, page1, left=True):
+    return [
+        DEACTIVATE_SCROLL,
+        LEFT_HORIZONTAL_SCROLL if left else RIGHT_HORIZONTAL_SCROLL,
+        0x00, page0, SCROLL_INTERVALS[frames], page1, 0x00, 0xFF,
+        ACTIVATE_SCROLL
+    ]
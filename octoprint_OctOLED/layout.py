@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+##~~ Auto-fit text layout
+# Finds the largest font size at which a string, wrapped at spaces, fits a width x height box, and
+# where each (centered) line goes. Sizes are binary searched: a bigger font never needs fewer lines.
+# Measurements come from FreeType once per (size, string) and layouts are cached per (text, box,
+# size range), so status text that keeps coming back is laid out without touching FreeType at all.
+
+# Smallest size tried
+MIN_FIT_SIZE = 8
+# Pixels between lines
+LINE_SPACING = 1
+
+
+# A finished layout: the font size, and each line as (text, x, y) where (x, y) is the position to pass
+# to GlyphAtlas.draw_text(). `fits` is False if even the smallest size doesn't fit (the lines are then
+# laid out at that size and get clipped).
+class TextLayout(object):
+    __slots__ = ("size", "lines", "fits")
+
+    def __init__(self, size, lines, fits):
+        self.size = size
+        self.lines = lines
+        self.fits = fits
+
+
+# Advance width and ink bounding box of strings at one font size, memoized
+class FontMetrics(object):
+    def __init__(self, font, max_entries=1024):
+        self.font = font
+        self.max_entries = max_entries
+        self._cache = dict()
+        # Strings measured by FreeType
+        self.misses = 0
+
+    # (advance width, (left, top, right, bottom) of the ink)
+    def measure(self, text):
+        metrics = self._cache.get(text)
+        if metrics is None:
+            if len(self._cache) >= self.max_entries:
+                self._cache.clear()
+            self.misses += 1
+            metrics = (self.font.getlength(text), self.font.getbbox(text))
+            self._cache[text] = metrics
+        return metrics
+
+
+# Used from OctoPrint's threads and the render thread at once
+class TextFitter(object):
+    # load_font(size) returns a PIL font, it is called once per size
+    def __init__(self, load_font, min_size=MIN_FIT_SIZE, max_layouts=64):
+        self._load_font = load_font
+        self.min_size = min_size
+        self.max_layouts = max_layouts
+        self._metrics = dict()
+        self._layouts = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def metrics(self, size):
+        with self._lock:
+            metrics = self._metrics.get(size)
+            if metrics is None:
+                metrics = FontMetrics(self._load_font(size))
+                self._metrics[size] = metrics
+            return metrics
+
+    # Layout of `text` in a width x height box at the largest size from min_size to max_size that fits
+    def fit(self, text, width, height, max_size):
+        key = (text, width, height, max_size)
+        with self._lock:
+            layout = self._layouts.get(key)
+            if layout is not None:
+                self.hits += 1
+                self._layouts.move_to_end(key)
+                return layout
+            self.misses += 1
+            layout = self._search(text, width, height, max(max_size, self.min_size))
+            self._layouts[key] = layout
+            if len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+            return layout
+
+    def _search(self, text, width, height, max_size):
+        best = None
+        low, high = self.min_size, max_size
+        while low <= high:
+            size = (low + high) // 2
+            layout = self._layout(text, width, height, size)
+            if layout.fits:
+                best = layout
+                low = size + 1
+            else:
+                high = size - 1
+        return best if best is not None else self._layout(text, width, height, self.min_size)
+
+    # Wrap greedily at spaces and center the block of lines. May not fit.
+    def _layout(self, text, width, height, size):
+        metrics = self.metrics(size)
+        lines = []
+        for paragraph in text.split("\n"):
+            line = None
+            for word in paragraph.split():
+                candidate = word if line is None else line + " " + word
+                if line is not None and metrics.measure(candidate)[0] > width:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = candidate
+            lines.append(line or "")
+
+        boxes = [metrics.measure(line) for line in lines]
+        ink_height = sum(bbox[3] - bbox[1] for advance, bbox in boxes if bbox[3] > bbox[1])
+        total = ink_height + LINE_SPACING * (len(lines) - 1)
+        fits = total <= height and all(advance <= width for advance, bbox in boxes)
+
+        placed = []
+        y = (height - total) // 2
+        for line, (advance, bbox) in zip(lines, boxes):
+            # draw_text() puts the ink `top` below y, line it up with the pen
+            placed.append((line, (width - int(round(advance))) // 2, y - bbox[1]))
+            if bbox[3] > bbox[1]:
+                y += bbox[3] - bbox[1] + LINE_SPACING
+        return TextLayout(size, placed, fits)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                cached_layouts=len(self._layouts),
+                measurements=sum(metrics.misses for metrics in self._metrics.values()),
+                sizes=sorted(self._metrics.keys())
+            )
@@ -0,0 +1,77 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import math
+
+from PIL import Image, ImageDraw
+
+##~~ Marquee
+# Scrolling text that is rendered once into a wide off-screen 1-bit strip. Every frame is then just a
+# crop of that strip at the current scroll position, so nothing gets rasterized (and no trig is done)
+# while scrolling.
+
+
+# Vertical offsets for a sine wave that repeats every `width` pixels, indexed by screen x
+def sine_table(width, amplitude):
+    return [int(math.floor(amplitude * math.sin(x / float(width) * 2.0 * math.pi))) for x in range(width)]
+
+
+class Marquee(object):
+    # atlas: GlyphAtlas to draw with
+    # width, height: size of the frames to produce
+    # gap: blank pixels between the end of the text and the start of the next repetition
+    # y: top of the text, centered vertically by default
+    # wave: optional table of per-column vertical offsets (see sine_table()); each character is moved
+    #       by the value at its current screen x
+    def __init__(self, atlas, text, width, height, gap=None, y=None, wave=None):
+        self.text = text
+        self.width = width
+        self.height = height
+        self.gap = width // 4 if gap is None else gap
+        self.wave = wave
+
+        positions, text_width = atlas.layout(text)
+        text_width = int(math.ceil(text_width))
+        text_height = atlas.getsize(text)[1]
+        self.text_width = text_width
+        self.y = (height - text_height) // 2 if y is None else int(y)
+        # One repetition of text + gap
+        self.period = max(1, text_width + self.gap)
+
+        strip = Image.new("1", (self.period, text_height))
+        atlas.draw_text(ImageDraw.Draw(strip), (0, 0), text)
+        # Tile the strip so any viewport is a single crop, wrapping included
+        tiles = width // self.period + 2
+        self._strip = Image.new("1", (self.period * tiles, text_height))
+        for i in range(tiles):
+            self._strip.paste(strip, (i * self.period, 0))
+
+        # Column span of every character, used to move characters individually for the wave
+        self._segments = []
+        for i, x in enumerate(positions):
+            end = positions[i + 1] if i + 1 < len(positions) else text_width
+            start, end = int(round(x)), int(round(end))
+            if end > start:
+                self._segments.append((start, end, strip.crop((start, 0, end, text_height))))
+        self._segment_starts = [segment[0] for segment in self._segments]
+
+    # Draw the viewport at scroll position `pos` (pixels, increasing scrolls the text left) into image
+    def render(self, image, pos):
+        x0 = int(pos) % self.period
+        image.paste(0, (0, 0, image.size[0], image.size[1]))
+        if self.wave is None:
+            image.paste(self._strip.crop((x0, 0, x0 + self.width, self._strip.size[1])), (0, self.y))
+            return
+        for repeat in range(0, self.width + self.period, self.period):
+            base = repeat - x0
+            # First character that is still (partially) on screen
+            first = max(0, bisect.bisect_right(self._segment_starts, -base) - 1)
+            for start, end, glyph in self._segments[first:]:
+                x = base + start
+                if x >= self.width:
+                    break
+                if x + (end - start) <= 0:
+                    continue
+                image.paste(glyph, (x, self.y + self.wave[x % self.width]))
+
@@ -0,0 +1,207 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import base64
+import json
+import threading
+import time
+from collections import deque
+
+from .displays import RateMeter, STATS_WINDOW
+
+# Browsers renew their subscription every few seconds while the preview is visible
+PREVIEW_LEASE = 30.0
+
+
+# Run-length encoding as (count, value) byte pairs, count 1-255
+def rle_encode(data):
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        value = data[i]
+        j = i + 1
+        while j < n and j - i < 255 and data[j] == value:
+            j += 1
+        out.append(j - i)
+        out.append(value)
+        i = j
+    return bytes(out)
+
+
+def rle_decode(data):
+    out = bytearray()
+    for i in range(0, len(data), 2):
+        out.extend(data[i + 1:i + 2] * data[i])
+    return bytes(out)
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+##~~ Preview encoding
+# Turns framebuffer snapshots (driver page layout) into messages for the browser. The first frame and
+# any frame after a size change is a key frame with every page. After that only the changed column
+# span of each changed page is sent, XORed with the previous frame so unchanged bytes become zero runs.
+# Every span is run-length encoded unless that makes it bigger, and base64 encoded for the JSON
+# plugin message as [page, first column, RLE used (0/1), data].
+class PreviewEncoder(object):
+    def __init__(self):
+        self._last = None
+        self._size = None
+        self.seq = 0
+
+    def reset(self):
+        self._last = None
+
+    @staticmethod
+    def _span(page, start, data):
+        rle = rle_encode(data)
+        if len(rle) < len(data):
+            return [page, start, 1, base64.b64encode(rle).decode("ascii")]
+        return [page, start, 0, base64.b64encode(data).decode("ascii")]
+
+    # Returns the message for `frame`, or None if nothing changed. `rotation` (0 or 2) tells the browser
+    # to turn the preview the same way the panel is mounted.
+    def encode(self, width, height, frame, rotation=0):
+        frame = bytes(frame)
+        key = self._last is None or self._size != (width, height)
+        pages = []
+        for page in range(height // 8):
+            start = page * width
+            data = frame[start:start + width]
+            if key:
+                pages.append(self._span(page, 0, data))
+                continue
+            last = self._last[start:start + width]
+            if data == last:
+                continue
+            c0 = 0
+            while data[c0] == last[c0]:
+                c0 += 1
+            c1 = width
+            while data[c1 - 1] == last[c1 - 1]:
+                c1 -= 1
+            pages.append(self._span(page, c0, xor_bytes(data[c0:c1], last[c0:c1])))
+        self._last = frame
+        self._size = (width, height)
+        if not pages:
+            return None
+        self.seq += 1
+        return dict(type="frame", seq=self.seq, key=key, width=width, height=height, rotation=rotation, pages=pages)
+
+
+##~~ Preview stream
+# Sends the main display's frames to subscribed browsers through plugin messages, at most max_rate
+# times per second. A burst of flushes is sent as its last frame once the rate allows. Nothing is
+# encoded or sent while nobody is subscribed.
+class PreviewStream(object):
+    # get_frame() returns (width, height, frame bytes, rotation); send(message) delivers a plugin message
+    def __init__(self, get_frame, send, logger, max_rate=5.0):
+        self._get_frame = get_frame
+        self._send = send
+        self._logger = logger
+        self._encoder = PreviewEncoder()
+        self._lock = threading.Lock()
+        self._clients = dict()
+        self._last_send = 0.0
+        self._timer = None
+        self.set_max_rate(max_rate)
+        self.messages = 0
+        self.bytes = 0
+        self.key_frames = 0
+        self.skipped = 0
+        self._rate = RateMeter()
+        # (time, size) of recent messages
+        self._recent = deque()
+
+    def set_max_rate(self, max_rate):
+        self.max_rate = float(max_rate)
+        self.min_interval = 1.0 / self.max_rate if self.max_rate > 0 else 0.0
+
+    @property
+    def active(self):
+        now = time.monotonic()
+        with self._lock:
+            for client, expires in list(self._clients.items()):
+                if expires < now:
+                    del self._clients[client]
+            return self.max_rate > 0 and len(self._clients) > 0
+
+    # A browser showing the preview (re)subscribes. New subscribers, and browsers that lost track of
+    # the stream (key_frame=True), get a key frame right away.
+    def subscribe(self, client, key_frame=False):
+        with self._lock:
+            key_frame = key_frame or client not in self._clients
+            self._clients[client] = time.monotonic() + PREVIEW_LEASE
+            if key_frame:
+                self._encoder.reset()
+        if key_frame:
+            self.notify()
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.pop(client, None)
+
+    # Called after every flush of the display
+    def notify(self):
+        if not self.active:
+            self.skipped += 1
+            return
+        with self._lock:
+            wait = self._last_send + self.min_interval - time.monotonic()
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._send_latest)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self._send_latest()
+
+    def _send_latest(self):
+        # Taken before our own lock, flushes hold the display lock while calling notify()
+        try:
+            frame = self._get_frame()
+        except Exception as err:
+            self._logger.error("Failed to read the frame for the preview: " + str(err))
+            return
+        with self._lock:
+            self._timer = None
+            self._last_send = time.monotonic()
+            message = self._encoder.encode(*frame)
+        if message is None:
+            return
+        size = len(json.dumps(message))
+        now = time.monotonic()
+        self.messages += 1
+        self.bytes += size
+        if message["key"]:
+            self.key_frames += 1
+        self._rate.add(now)
+        self._recent.append((now, size))
+        self._send(message)
+
+    def bytes_per_second(self):
+        now = time.monotonic()
+        while self._recent and self._recent[0][0] < now - STATS_WINDOW:
+            self._recent.popleft()
+        return sum(size for at, size in self._recent) / STATS_WINDOW
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def stats(self):
+        return dict(
+            clients=len(self._clients),
+            max_rate=self.max_rate,
+            messages=self.messages,
+            key_frames=self.key_frames,
+            bytes=self.bytes,
+            skipped=self.skipped,
+            messages_per_second=self._rate.rate(),
+            bytes_per_second=self.bytes_per_second()
+        )
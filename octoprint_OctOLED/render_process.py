@@ -0,0 +1,483 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+##~~ Render process
+# Optional mode (setting "render_process") in which a worker process owns the displays and does all of
+# the rendering: text, widgets, animations, sprites, draw lists and every I2C transfer. OctoPrint's
+# process is left with coalescing updates (update queue, refresh governor) and the API, so Pillow,
+# FreeType and blocking bus writes no longer hold the GIL that the printer's serial thread needs.
+#
+# The worker runs a second, headless OctOLEDPlugin: the same rendering code, with the parts that talk
+# to OctoPrint swapped for stand-ins that talk to the plugin instead. The two processes share:
+#
+#   commands  plugin -> worker queue of small tuples: coalesced updates, settings, draw lists, calls
+#   events    worker -> plugin queue: replies to calls, log records, updates for the update queue,
+#             "a frame was flushed" and a heartbeat
+#   frames    shared memory with the frame on the main display (read by the live preview) and an inbox
+#             for pushed frames, so frame data never goes through a queue
+#
+# RenderProcess supervises the worker: one that exits, or stops sending heartbeats, is replaced after
+# a delay that doubles with every failed attempt, and the new one gets the latest settings and
+# printer state.
+
+# Largest frame that fits the shared memory: 256x256 pixels, bigger than any SSD1306
+MAX_FRAME_BYTES = 8192
+# Shared memory header: width, height, rotation of the published frame and frames published so far
+FRAME_HEADER = struct.Struct("<HHHI")
+
+# Seconds between heartbeats, and without one before the worker counts as hung (a single command,
+# e.g. compiling a big sprite, must not take longer)
+HEARTBEAT_INTERVAL = 1.0
+HANG_TIMEOUT = 30.0
+# Delay before restarting a worker, doubled after every restart that didn't last STABLE_AFTER seconds
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+# Seconds to wait for the answer to a call
+CALL_TIMEOUT = 10.0
+
+
+# The frame on the worker's main display and the pushed frame inbox, in one shared block guarded by
+# one lock. Built on both sides from the same RawArray and Lock.
+class SharedFrames(object):
+    def __init__(self, array, lock):
+        self.array = array
+        self.lock = lock
+        self._view = memoryview(array).cast("B")
+        self._frame = FRAME_HEADER.size
+        self._inbox = FRAME_HEADER.size + MAX_FRAME_BYTES
+
+    @staticmethod
+    def allocate(context):
+        return context.RawArray("B", FRAME_HEADER.size + 2 * MAX_FRAME_BYTES), context.Lock()
+
+    # Worker side, after every flush of the main display. Returns False if the frame is too big.
+    def publish(self, width, height, data, rotation):
+        if len(data) > MAX_FRAME_BYTES:
+            return False
+        with self.lock:
+            frames = FRAME_HEADER.unpack_from(self._view, 0)[3]
+            self._view[self._frame:self._frame + len(data)] = data
+            FRAME_HEADER.pack_into(self._view, 0, width, height, rotation, (frames + 1) & 0xFFFFFFFF)
+        return True
+
+    # Plugin side: (width, height, page data, rotation) like OctOLEDPlugin._preview_frame
+    def read(self):
+        with self.lock:
+            width, height, rotation, frames = FRAME_HEADER.unpack_from(self._view, 0)
+            size = width * ((height + 7) // 8)
+            return width, height, bytes(self._view[self._frame:self._frame + size]), rotation
+
+    @property
+    def published(self):
+        with self.lock:
+            return FRAME_HEADER.unpack_from(self._view, 0)[3]
+
+    # Plugin side. The caller keeps the inbox until the worker has read it. May throw ValueError.
+    def write_inbox(self, data):
+        if len(data) > MAX_FRAME_BYTES:
+            raise ValueError("Frame too large: " + str(len(data)) + " bytes")
+        with self.lock:
+            self._view[self._inbox:self._inbox + len(data)] = data
+
+    def read_inbox(self, length):
+        with self.lock:
+            return bytes(self._view[self._inbox:self._inbox + length])
+
+
+# Errors from the worker are raised again in the plugin with the same type for the ones callers
+# handle (bad input, bus errors), anything else becomes a RuntimeError
+def _remote_error(name, message):
+    if name == "ValueError":
+        return ValueError(message)
+    if name in ("OSError", "IOError", "TimeoutError"):
+        return OSError(message)
+    return RuntimeError(name + ": " + message)
+
+
+##~~ Plugin side
+
+class RenderProcess(object):
+    # get_settings() returns the settings dict (SettingsSnapshot.as_dict()) a new worker starts with.
+    # on_update(key, value) feeds the update queue, on_frame() is called after every flush of the main
+    # display and on_restart() once a replacement worker is up, all on the supervisor thread.
+    def __init__(self, get_settings, data_folder, logger, on_update, on_frame, on_restart):
+        self._get_settings = get_settings
+        self._data_folder = data_folder
+        self._logger = logger
+        self._on_update = on_update
+        self._on_frame = on_frame
+        self._on_restart = on_restart
+        # Forking OctoPrint (a threaded server) could copy held locks into the child
+        self._context = multiprocessing.get_context("spawn")
+        array, lock = SharedFrames.allocate(self._context)
+        self.frames = SharedFrames(array, lock)
+        self._lock = threading.Lock()
+        self._push_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._process = None
+        self._commands = None
+        self._events = None
+        self._calls = dict()
+        self._next_call = 0
+        self._ready = threading.Event()
+        self._start_error = None
+        self._supervisor = None
+        # "starting", "running", "restarting", "stopped"
+        self.state = "stopped"
+        self.restarts = 0
+        self._failures = 0
+        self._started = None
+        self._last_heartbeat = None
+        self.commands_sent = 0
+        self.events_received = 0
+        # Startup timings reported by the worker
+        self.startup_timings = dict()
+
+    # Start the worker and wait until its displays are up. May throw (the worker's error on failure,
+    # RuntimeError on timeout).
+    def start(self, timeout):
+        self._stopping.clear()
+        self._spawn("starting")
+        self._supervisor = threading.Thread(target=self._supervise, name="OctOLED-supervisor", daemon=True)
+        self._supervisor.start()
+        if not self._ready.wait(timeout):
+            self.stop()
+            raise RuntimeError("Render process didn't start within " + str(timeout) + " s")
+        if self._start_error is not None:
+            self.stop()
+            raise self._start_error
+
+    def stop(self, timeout=2.0):
+        self._stopping.set()
+        with self._lock:
+            process = self._process
+            if process is not None and process.is_alive():
+                self._commands.put((None, "stop", ()))
+            self.state = "stopped"
+        if process is not None:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        if self._supervisor is not None and self._supervisor is not threading.current_thread():
+            self._supervisor.join(timeout)
+        self._close_queues()
+        self._fail_calls()
+
+    # Queue a command without waiting for it. Dropped while there is no running worker.
+    def send(self, command, *args):
+        with self._lock:
+            if self.state != "running":
+                return False
+            self._commands.put((None, command, args))
+            self.commands_sent += 1
+            return True
+
+    # Run a command in the worker and return its result. Returns None if there is no running worker or
+    # it doesn't answer in time. Raises the worker's error.
+    def call(self, command, *args, timeout=CALL_TIMEOUT):
+        with self._lock:
+            if self.state != "running":
+                return None
+            call_id = self._next_call
+            self._next_call += 1
+            # [answered, result, error]
+            waiter = [threading.Event(), None, None]
+            self._calls[call_id] = waiter
+            self._commands.put((call_id, command, args))
+            self.commands_sent += 1
+        if not waiter[0].wait(timeout):
+            self._logger.warning("Render process didn't answer " + command + " within " + str(timeout) + " s")
+            with self._lock:
+                self._calls.pop(call_id, None)
+            return None
+        if waiter[2] is not None:
+            raise _remote_error(*waiter[2])
+        return waiter[1]
+
+    # Pushed frames go through the inbox, one at a time
+    def push_frame(self, data, box):
+        with self._push_lock:
+            self.frames.write_inbox(data)
+            return self.call("push_frame", box, len(data))
+
+    # state: "starting" for the first worker, "restarting" for replacements
+    def _spawn(self, state):
+        with self._lock:
+            self._ready.clear()
+            self._start_error = None
+            # New queues every time: a worker that died while writing leaves its queue unusable
+            self._close_queues()
+            self._commands = self._context.Queue()
+            self._events = self._context.Queue()
+            self._process = self._context.Process(
+                target=run_worker,
+                args=(self._get_settings(), self._data_folder, self._logger.name, self._logger.getEffectiveLevel(),
+                      os.getpid(), self._commands, self._events, self.frames.array, self.frames.lock),
+                name="OctOLED-render",
+                daemon=True
+            )
+            self.state = state
+            self._process.start()
+            self._started = time.monotonic()
+            self._last_heartbeat = self._started
+        self._logger.info("Started render process " + str(self._process.pid))
+
+    # Commands nobody will read mustn't keep OctoPrint from exiting
+    def _close_queues(self):
+        for q in (self._commands, self._events):
+            if q is not None:
+                q.close()
+                q.cancel_join_thread()
+
+    ##~ Supervisor thread: handles events and replaces workers that died or hung
+
+    def _supervise(self):
+        while not self._stopping.is_set():
+            try:
+                event = self._events.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                event = None
+            except Exception as err:
+                # The worker died while writing an event
+                self._logger.debug("Lost a render process event: " + str(err))
+                event = None
+            if event is not None:
+                self._handle_event(event)
+            if self._stopping.is_set():
+                break
+            problem = self._check_worker()
+            if problem is not None:
+                self._restart(problem)
+
+    def _handle_event(self, event):
+        self.events_received += 1
+        kind = event[0]
+        if kind == "frame":
+            self._on_frame()
+        elif kind == "update":
+            self._on_update(event[1], event[2])
+        elif kind == "reply":
+            with self._lock:
+                waiter = self._calls.pop(event[1], None)
+            if waiter is not None:
+                waiter[1], waiter[2] = event[2], event[3]
+                waiter[0].set()
+        elif kind == "log":
+            self._logger.handle(event[1])
+        elif kind == "alive":
+            self._last_heartbeat = time.monotonic()
+        elif kind == "ready":
+            self._last_heartbeat = time.monotonic()
+            self.startup_timings = event[1]
+            with self._lock:
+                restarted = self.state == "restarting"
+                self.state = "running"
+            self._ready.set()
+            if restarted:
+                self._logger.info("Render process " + str(self._process.pid) + " is back up")
+                self._on_restart()
+        elif kind == "failed":
+            self._start_error = _remote_error(event[1], event[2])
+            if self.state == "starting":
+                # start() reports it
+                self._ready.set()
+            else:
+                self._logger.error("Render process failed to start: " + event[2])
+
+    # Reason to replace the worker, or None if it's fine
+    def _check_worker(self):
+        process = self._process
+        if process is None:
+            return None
+        if self.state == "starting":
+            # start() reports the first worker dying, it isn't restarted
+            if not process.is_alive() and not self._ready.is_set():
+                self._start_error = RuntimeError("Render process exited with code " + str(process.exitcode))
+                self._ready.set()
+            return None
+        if not process.is_alive():
+            return "exited with code " + str(process.exitcode)
+        if time.monotonic() - self._last_heartbeat > HANG_TIMEOUT:
+            return "stopped responding"
+        return None
+
+    def _restart(self, problem):
+        process = self._process
+        with self._lock:
+            self.state = "restarting"
+        self._logger.error("Render process " + str(process.pid) + " " + problem + ", restarting it")
+        if process.is_alive():
+            process.kill()
+            process.join(1.0)
+        self._fail_calls()
+        if time.monotonic() - self._started >= STABLE_AFTER:
+            self._failures = 0
+        delay = min(RESTART_DELAY * 2 ** self._failures, MAX_RESTART_DELAY)
+        self._failures += 1
+        if self._stopping.wait(delay):
+            return
+        self.restarts += 1
+        self._spawn("restarting")
+
+    # Calls waiting for a worker that is gone get None
+    def _fail_calls(self):
+        with self._lock:
+            calls = list(self._calls.values())
+            self._calls.clear()
+        for waiter in calls:
+            waiter[0].set()
+
+    def stats(self):
+        process = self._process
+        return dict(
+            state=self.state,
+            pid=process.pid if process is not None else None,
+            uptime=time.monotonic() - self._started if self.state == "running" else 0,
+            restarts=self.restarts,
+            commands=self.commands_sent,
+            events=self.events_received,
+            frames=self.frames.published,
+            heartbeat_age=time.monotonic() - self._last_heartbeat if self._last_heartbeat is not None else None
+        )
+
+
+##~~ Worker side
+
+# Log records go to the plugin's logger in OctoPrint's process
+class _EventLogHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        self.queue.put(("log", record))
+
+
+# Stand-in for the update queue: updates from the worker (e.g. "redraw" after a sprite) are queued by
+# the plugin, which does the rate limiting
+class UpdateForwarder(object):
+    def __init__(self, events):
+        self._events = events
+
+    def submit(self, key, value):
+        self._events.put(("update", key, value))
+
+
+# Stand-in for the preview stream: publishes every flushed frame for the plugin's preview
+class FramePublisher(object):
+    def __init__(self, frames, get_frame, events, logger):
+        self._frames = frames
+        self._get_frame = get_frame
+        self._events = events
+        self._logger = logger
+        self._too_large = False
+
+    def notify(self):
+        if self._frames.publish(*self._get_frame()):
+            self._events.put(("frame",))
+        elif not self._too_large:
+            self._too_large = True
+            self._logger.warning("Display too large for the shared frame, the preview won't show it")
+
+
+# Commands the worker runs, on its main thread. Like the plugin's update thread, they draw under the
+# plugin's display lock and the render loop keeps playing animations meanwhile.
+class RenderWorker(object):
+    def __init__(self, plugin, frames):
+        self._plugin = plugin
+        self._frames = frames
+
+    def updates(self, updates):
+        self._plugin._apply_updates(updates)
+
+    def settings(self, values, changed):
+        from .settings import SettingsSnapshot
+        plugin = self._plugin
+        plugin._config = SettingsSnapshot(values)
+        plugin._enabled = plugin._config.enabled
+        plugin._apply_display_settings(set(changed))
+
+    def suspend(self, asleep, max_fps=None):
+        self._plugin._asleep = asleep
+        self._plugin._render_max_fps = max_fps
+        self._plugin._suspend_displays()
+
+    def push_frame(self, box, length):
+        return self._plugin.push_frame(self._frames.read_inbox(length), box)
+
+    def draw(self, ops, clear):
+        return self._plugin.draw(ops, clear=clear)
+
+    def play_sprite(self, source, loop):
+        return self._plugin.play_sprite(source, loop=loop)
+
+    def stop_sprite(self):
+        self._plugin.stop_sprite()
+
+    def stats(self):
+        return self._plugin._display_stats()
+
+
+# Entry point of the worker process
+def run_worker(settings, data_folder, logger_name, log_level, parent_pid, commands, events, array, lock):
+    logger = logging.getLogger(logger_name)
+    logger.handlers = [_EventLogHandler(events)]
+    logger.setLevel(log_level)
+    logger.propagate = False
+
+    from . import OctOLEDPlugin
+    from .animation import RenderLoop
+    from .settings import SettingsSnapshot
+    frames = SharedFrames(array, lock)
+    plugin = OctOLEDPlugin()
+    plugin._identifier = "OctOLED"
+    plugin._logger = logger
+    plugin._data_folder = data_folder
+    plugin._config = SettingsSnapshot(settings)
+    plugin._enabled = plugin._config.enabled
+    plugin._update_queue = UpdateForwarder(events)
+    plugin._preview = FramePublisher(frames, plugin._preview_frame, events, logger)
+    started = time.monotonic()
+    try:
+        plugin._render_loop = RenderLoop(logger)
+        plugin.init_display()
+    except Exception as err:
+        events.put(("failed", type(err).__name__, str(err)))
+        return
+    plugin._startup_timings["total"] = (time.monotonic() - started) * 1000
+    events.put(("ready", dict(plugin._startup_timings)))
+
+    worker = RenderWorker(plugin, frames)
+    last_heartbeat = time.monotonic()
+    while True:
+        try:
+            call_id, command, args = commands.get(timeout=HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            call_id, command = None, None
+        now = time.monotonic()
+        if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+            # Don't outlive OctoPrint
+            if os.getppid() != parent_pid:
+                break
+            events.put(("alive",))
+            last_heartbeat = now
+        if command is None:
+            continue
+        if command == "stop":
+            break
+        result, error = None, None
+        try:
+            result = getattr(worker, command)(*args)
+        except Exception as err:
+            error = (type(err).__name__, str(err))
+        if call_id is not None:
+            events.put(("reply", call_id, result, error))
+        elif error is not None:
+            logger.error("Render command " + command + " failed: " + error[1])
+    plugin._render_loop.stop()
@@ -0,0 +1,106 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import copy
+from collections import OrderedDict
+
+
+# "0x3D", "61" or 61 -> 61
+def parse_address(address):
+    if isinstance(address, int):
+        return address
+    return int(str(address), 0)
+
+
+# "1", 1 -> 1; "" or None -> None (the backend's default bus)
+def optional_int(value):
+    return None if value is None or value == "" else int(value)
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def _bool(value):
+    if isinstance(value, str):
+        return value.lower() in ("true", "1", "yes", "on")
+    return bool(value)
+
+
+# Setting -> conversion to the type the plugin works with. Lists are deep copied so a snapshot never
+# changes after it was taken.
+SETTINGS_TYPES = OrderedDict([
+    ("enabled", _bool),
+    ("display_text", _text),
+    ("display_font_size", int),
+    ("auto_fit", _bool),
+    ("display_width", int),
+    ("display_height", int),
+    ("rotate_180", _bool),
+    ("demo_anim", _bool),
+    ("scroll_mode", _text),
+    ("scroll_speed", float),
+    ("scroll_fps", int),
+    ("scroll_hardware", _bool),
+    ("display_mode", _text),
+    ("status_format", _text),
+    ("max_refresh_rate", float),
+    ("adaptive_refresh", _bool),
+    ("printing_refresh_rate", float),
+    ("idle_refresh_rate", float),
+    ("sleep_timeout", float),
+    ("preview_rate", float),
+    ("init_timeout", float),
+    ("render_process", _bool),
+    ("display_backend", _text),
+    ("display_address", parse_address),
+    ("display_bus", optional_int),
+    ("i2c_frequency", int),
+    ("i2c_chunk_size", int),
+    ("i2c_retries", int),
+    ("i2c_retry_backoff_ms", float),
+    ("extra_displays", lambda value: copy.deepcopy(list(value or []))),
+    ("widgets", lambda value: copy.deepcopy(list(value or [])))
+])
+
+
+##~~ Settings snapshot
+# All of the plugin's settings read once and converted, e.g. config.display_width. Taking a new
+# snapshot on SettingsUpdated and comparing it to the previous one tells which settings the user
+# actually changed.
+class SettingsSnapshot(object):
+    def __init__(self, values, invalid=()):
+        self._values = values
+        # Settings that couldn't be converted and were replaced by their defaults
+        self.invalid = list(invalid)
+
+    # May throw ValueError/TypeError on settings that can't be converted, unless `defaults` (the
+    # plugin's settings defaults) is given to use in their place
+    @classmethod
+    def read(cls, settings, defaults=None):
+        values = dict()
+        invalid = []
+        for name, convert in SETTINGS_TYPES.items():
+            try:
+                values[name] = convert(settings.get([name]))
+            except (TypeError, ValueError):
+                if defaults is None:
+                    raise
+                values[name] = convert(defaults[name])
+                invalid.append(name)
+        return cls(values, invalid)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["_values"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    # Names of the settings that differ from `other` (all of them if there is nothing to compare to)
+    def changed(self, other):
+        if other is None:
+            return set(SETTINGS_TYPES.keys())
+        return set(name for name in SETTINGS_TYPES if self._values[name] != other._values[name])
+
+    def as_dict(self):
+        return dict(self._values)
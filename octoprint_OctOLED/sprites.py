@@ -0,0 +1,254 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .framebuffer import FrameDiffer, can_pack, pack_image
+
+##~~ Sprite files
+# GIFs, APNGs and directories of images are compiled once per display geometry into a file of packed
+# frames in the panel's page layout, so playing them back needs no decoding, no PIL and no diffing:
+#
+#   header       magic, width, height, rotation, frame count, offset of the frame data
+#   frame table  per frame: duration (ms), index of its first rect, rect count
+#   rect table   per frame: the windows (page0, page1, col0, col1) that differ from the frame before it
+#                (from the last frame for frame 0, for looping)
+#   frame data   width * height / 8 bytes per frame
+#
+# Files are named after a hash of the source and the geometry, so a new resolution or rotation simply
+# compiles (and later finds) another file.
+
+SPRITE_MAGIC = b"OLEDSPR1"
+HEADER = struct.Struct("<8sHHHHII")
+FRAME_ENTRY = struct.Struct("<III")
+RECT = struct.Struct("<BBBB")
+SPRITE_EXTENSION = ".sprite"
+
+# Frames without a usable duration (GIFs often say 0) are shown this long, in ms
+DEFAULT_DURATION = 100
+IMAGE_EXTENSIONS = (".png", ".gif", ".bmp", ".jpg", ".jpeg", ".pbm", ".ppm", ".webp")
+
+
+# Hash of the source file, or of the names and contents of the images in a source directory
+def source_hash(source):
+    digest = hashlib.sha1()
+    paths = _sequence_paths(source) if os.path.isdir(source) else [source]
+    for path in paths:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sequence_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+# (PIL image, duration in ms) for every frame of the source
+def _read_frames(source):
+    from PIL import Image, ImageSequence
+    if os.path.isdir(source):
+        paths = _sequence_paths(source)
+        if not paths:
+            raise ValueError("No images in " + source)
+        for path in paths:
+            with Image.open(path) as image:
+                yield image.convert("RGBA"), DEFAULT_DURATION
+        return
+    with Image.open(source) as image:
+        for frame in ImageSequence.Iterator(image):
+            duration = frame.info.get("duration") or 0
+            yield frame.convert("RGBA"), int(duration) if duration > 10 else DEFAULT_DURATION
+
+
+# Scale down (keeping the aspect ratio) and center on a black width x height mode "1" image
+def _fit(image, width, height):
+    from PIL import Image
+    if image.width > width or image.height > height:
+        image.thumbnail((width, height))
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 255))
+    canvas.alpha_composite(image, ((width - image.width) // 2, (height - image.height) // 2))
+    return canvas.convert("L").convert("1")
+
+
+# (mode "1" width x height image, duration in ms) for every frame of the source
+def load_frames(source, width, height):
+    for image, duration in _read_frames(source):
+        yield _fit(image, width, height), duration
+
+
+# Compile `source` into a sprite file at `path` for a width x height panel. May throw.
+def compile_sprite(source, path, width, height, rotation=0):
+    if not can_pack(rotation):
+        raise ValueError("Sprites only support rotations 0 and 180.")
+    frames = []
+    durations = []
+    for image, duration in load_frames(source, width, height):
+        data = bytearray(width * height // 8)
+        pack_image(image, data, width, height, rotation, offset=0)
+        frames.append(bytes(data))
+        durations.append(duration)
+    if not frames:
+        raise ValueError("No frames in " + source)
+
+    differ = FrameDiffer(width, height)
+    rects = []
+    entries = []
+    for index, frame in enumerate(frames):
+        differ.assume(frames[index - 1])
+        frame_rects, _ = differ.plan(frame)
+        entries.append(FRAME_ENTRY.pack(durations[index], len(rects), len(frame_rects)))
+        rects.extend(frame_rects)
+
+    data_offset = HEADER.size + FRAME_ENTRY.size * len(frames) + RECT.size * len(rects)
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(HEADER.pack(SPRITE_MAGIC, width, height, rotation, 0, len(frames), data_offset))
+        f.write(b"".join(entries))
+        f.write(b"".join(RECT.pack(*rect) for rect in rects))
+        f.write(b"".join(frames))
+    os.replace(temp, path)
+
+
+##~~ Sprite
+# A compiled sprite file, memory mapped. frame(i) is a zero-copy view of the packed frame.
+class Sprite(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.width, self.height, self.rotation, _, count, data_offset = HEADER.unpack_from(self._map)
+            if magic != SPRITE_MAGIC:
+                raise ValueError("Not a sprite file: " + path)
+            self.frame_size = self.width * self.height // 8
+            if len(self._map) != data_offset + count * self.frame_size:
+                raise ValueError("Truncated sprite file: " + path)
+            self.durations = []
+            self._rects = []
+            rect_table = HEADER.size + FRAME_ENTRY.size * count
+            for index in range(count):
+                duration, first, rect_count = FRAME_ENTRY.unpack_from(self._map, HEADER.size + index * FRAME_ENTRY.size)
+                self.durations.append(duration / 1000.0)
+                self._rects.append([RECT.unpack_from(self._map, rect_table + (first + i) * RECT.size) for i in range(rect_count)])
+        except Exception:
+            self._map.close()
+            raise
+        self._data = memoryview(self._map)[data_offset:]
+
+    def __len__(self):
+        return len(self.durations)
+
+    def frame(self, index):
+        start = index * self.frame_size
+        return self._data[start:start + self.frame_size]
+
+    # Windows that changed since the frame before `index`, as (page0, page1, col0, col1)
+    def rects(self, index):
+        return self._rects[index]
+
+
+##~~ Sprite cache
+# Compiled sprites in `directory`, at most max_entries of them (the least recently played are removed)
+class SpriteCache(object):
+    def __init__(self, directory, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (path, size, mtime) -> source hash, so unchanged sources aren't read again
+        self._hashes = dict()
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+
+    def path(self, digest, width, height, rotation):
+        return os.path.join(self.directory, "{0}-{1}x{2}-r{3}{4}".format(digest, width, height, rotation, SPRITE_EXTENSION))
+
+    def _hash(self, source):
+        # A directory's mtime doesn't change when an image in it is edited
+        if os.path.isdir(source):
+            return source_hash(source)
+        stat = os.stat(source)
+        key = (os.path.abspath(source), stat.st_size, stat.st_mtime)
+        digest = self._hashes.get(key)
+        if digest is None:
+            digest = source_hash(source)
+            self._hashes[key] = digest
+        return digest
+
+    # The sprite for `source` at this geometry, compiled if it isn't cached yet. May throw.
+    def get(self, source, width, height, rotation=0):
+        with self._lock:
+            path = self.path(self._hash(source), width, height, rotation)
+            if os.path.exists(path):
+                self.hits += 1
+                os.utime(path, None)
+            else:
+                self.misses += 1
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                start = time.monotonic()
+                compile_sprite(source, path, width, height, rotation)
+                self.compile_time += time.monotonic() - start
+                self._prune()
+            return Sprite(path)
+
+    def _prune(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(SPRITE_EXTENSION)]
+        files.sort(key=os.path.getmtime, reverse=True)
+        for path in files[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            compile_ms=self.compile_time * 1000
+        )
+
+
+##~~ Sprite player
+# Coroutine animation for RenderLoop.play(): copies each frame into the display's buffer with
+# write(data) and waits for its duration. The flush passed to play() should hand `pending` to
+# Display.flush(), which then sends the precomputed windows instead of diffing the frame.
+class SpritePlayer(object):
+    def __init__(self, sprite, write, loop=True):
+        self.sprite = sprite
+        self._write = write
+        self.loop = loop
+        # (rects, base) for the frame waiting to be flushed
+        self.pending = (None, None)
+
+    async def run(self, ctx):
+        sprite = self.sprite
+        previous = None
+        index = 0
+        # Seconds the render loop let pass without a frame (it fell behind, or its frame rate is capped),
+        # caught up with by skipping frames
+        behind = 0.0
+        while True:
+            skipped = False
+            while behind >= sprite.durations[index] and (self.loop or index + 1 < len(sprite)):
+                behind -= sprite.durations[index]
+                index = (index + 1) % len(sprite)
+                skipped = True
+            self._write(sprite.frame(index))
+            # The compiled windows only cover the change from the frame before
+            self.pending = (None, None) if skipped else (sprite.rects(index), previous)
+            previous = sprite.frame(index)
+            steps = await ctx.present(sprite.durations[index])
+            behind += (steps - 1) * ctx.scheduler.interval
+            index += 1
+            if index == len(sprite):
+                if not self.loop:
+                    return
+                index = 0
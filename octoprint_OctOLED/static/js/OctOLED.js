@@ -8,11 +8,118 @@ $(function() {
     function OctoledViewModel(parameters) {
         var self = this;
 
-        // assign the injected parameters, e.g.:
-        // self.loginStateViewModel = parameters[0];
-        // self.settingsViewModel = parameters[1];
+        self.settingsViewModel = parameters[0];
 
-        // TODO: Implement your plugin's view model here.
+        // Live preview of the display in the settings dialog. The plugin only streams frames while a
+        // browser is subscribed, the subscription is renewed every few seconds while the dialog is open.
+        self.clientId = Math.random().toString(36).substr(2, 10);
+        self.renewInterval = undefined;
+        // Last frame in the display's page layout: one byte per column of 8 pixels, LSB at the top
+        self.frame = null;
+        self.width = 0;
+        self.height = 0;
+        self.rotation = 0;
+        self.seq = null;
+        self.awaitingKeyFrame = false;
+
+        self.subscribe = function(keyFrame) {
+            self.awaitingKeyFrame = self.awaitingKeyFrame || !!keyFrame;
+            OctoPrint.simpleApiCommand("OctOLED", "preview", {client: self.clientId, key_frame: !!keyFrame});
+        };
+
+        self.onSettingsShown = function() {
+            self.frame = null;
+            self.subscribe(true);
+            self.renewInterval = setInterval(function() { self.subscribe(false); }, 10000);
+        };
+
+        self.onSettingsHidden = function() {
+            clearInterval(self.renewInterval);
+            self.renewInterval = undefined;
+            self.frame = null;
+            OctoPrint.simpleApiCommand("OctOLED", "preview", {client: self.clientId, active: false});
+        };
+
+        // base64 of raw bytes, or of (count, value) byte pairs if rle is set -> bytes
+        self.decodeSpan = function(encoded, rle) {
+            var raw = atob(encoded);
+            var out = [];
+            if (!rle) {
+                for (var k = 0; k < raw.length; k++) {
+                    out.push(raw.charCodeAt(k));
+                }
+                return out;
+            }
+            for (var i = 0; i + 1 < raw.length; i += 2) {
+                var count = raw.charCodeAt(i);
+                var value = raw.charCodeAt(i + 1);
+                for (var j = 0; j < count; j++) {
+                    out.push(value);
+                }
+            }
+            return out;
+        };
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== "OctOLED" || data.type !== "frame" || self.renewInterval === undefined) {
+                return;
+            }
+            if (data.key) {
+                self.awaitingKeyFrame = false;
+                self.width = data.width;
+                self.height = data.height;
+                self.frame = new Uint8Array(data.width * data.height / 8);
+            } else if (self.frame === null || data.seq !== self.seq + 1) {
+                // Missed a diff, start over from a key frame
+                self.frame = null;
+                if (!self.awaitingKeyFrame) {
+                    self.subscribe(true);
+                }
+                return;
+            }
+            self.seq = data.seq;
+            self.rotation = data.rotation;
+            // [page, first column, rle, data]
+            _.each(data.pages, function(entry) {
+                var offset = entry[0] * self.width + entry[1];
+                var bytes = self.decodeSpan(entry[3], entry[2]);
+                for (var i = 0; i < bytes.length; i++) {
+                    self.frame[offset + i] = data.key ? bytes[i] : self.frame[offset + i] ^ bytes[i];
+                }
+            });
+            self.draw();
+        };
+
+        self.draw = function() {
+            var canvas = document.getElementById("octoled_preview");
+            if (!canvas || self.frame === null) {
+                return;
+            }
+            canvas.width = self.width;
+            canvas.height = self.height;
+            var ctx = canvas.getContext("2d");
+            var image = ctx.createImageData(self.width, self.height);
+            for (var page = 0; page < self.height / 8; page++) {
+                for (var x = 0; x < self.width; x++) {
+                    var column = self.frame[page * self.width + x];
+                    for (var bit = 0; bit < 8; bit++) {
+                        var px = x;
+                        var py = page * 8 + bit;
+                        if (self.rotation === 2) {
+                            px = self.width - 1 - px;
+                            py = self.height - 1 - py;
+                        }
+                        var value = (column >> bit) & 1 ? 255 : 0;
+                        var index = (py * self.width + px) * 4;
+                        image.data[index] = value;
+                        image.data[index + 1] = value;
+                        image.data[index + 2] = value;
+                        image.data[index + 3] = 255;
+                    }
+                }
+            }
+            ctx.putImageData(image, 0, 0);
+        };
     }
 
     /* view model class, parameters for constructor, container to bind to
@@ -22,7 +129,7 @@ $(function() {
     OCTOPRINT_VIEWMODELS.push({
         construct: OctoledViewModel,
         // ViewModels your plugin depends on, e.g. loginStateViewModel, settingsViewModel, ...
-        dependencies: [ /* "loginStateViewModel", "settingsViewModel" */ ],
+        dependencies: [ "settingsViewModel" ],
         // Elements to bind to, e.g. #settings_plugin_OctOLED, #tab_plugin_OctOLED, ...
         elements: [ /* ... */ ]
     });
@@ -0,0 +1,28 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+
+# Running count/total/max of a duration, in seconds
+class TimingStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.last = duration
+        if duration > self.max:
+            self.max = duration
+
+    def as_dict(self):
+        return dict(
+            avg_ms=(self.total / self.count) * 1000 if self.count else 0,
+            max_ms=self.max * 1000,
+            last_ms=self.last * 1000
+        )
@@ -0,0 +1,146 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import time
+from collections import deque
+
+from .framebuffer import CMD_CONTROL_BYTE, DATA_CONTROL_BYTE, SET_COL_ADDR, SET_PAGE_ADDR
+
+# Window for the bytes/sec figure
+THROUGHPUT_WINDOW = 5.0
+
+# Upper bounds of the flush latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+# Flush latency histogram, throughput and error counters for one display
+class TransferStats(object):
+    def __init__(self):
+        self.flushes = 0
+        self.bytes = 0
+        self.writes = 0
+        self.errors = 0
+        self.retries = 0
+        self.failures = 0
+        self.last_error = None
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # (time, bytes) of recent flushes
+        self._recent = deque()
+
+    def record_flush(self, duration, sent, now=None):
+        now = time.monotonic() if now is None else now
+        self.flushes += 1
+        self.bytes += sent
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, duration * 1000)] += 1
+        self._recent.append((now, sent))
+        self._trim(now)
+
+    def _trim(self, now):
+        while self._recent and self._recent[0][0] < now - THROUGHPUT_WINDOW:
+            self._recent.popleft()
+
+    def bytes_per_second(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._trim(now)
+        return sum(sent for at, sent in self._recent) / THROUGHPUT_WINDOW
+
+    def as_dict(self):
+        labels = ["<=" + str(ms) + "ms" for ms in LATENCY_BUCKETS_MS] + [">" + str(LATENCY_BUCKETS_MS[-1]) + "ms"]
+        return dict(
+            flushes=self.flushes,
+            bytes=self.bytes,
+            writes=self.writes,
+            bytes_per_second=self.bytes_per_second(),
+            avg_flush_ms=(self.total_time / self.flushes) * 1000 if self.flushes else 0,
+            max_flush_ms=self.max_time * 1000,
+            latency_histogram=dict(zip(labels, self.histogram)),
+            errors=self.errors,
+            retries=self.retries,
+            failures=self.failures,
+            last_error=self.last_error
+        )
+
+
+##~~ I2C transport
+# Everything OctOLED sends to a panel goes through here. Window commands are batched into one
+# transaction, display data is split into chunks of at most chunk_size bytes (0 = no limit) for
+# adapters with small transfer limits, and transient OSErrors are retried with exponential backoff.
+class I2CTransport(object):
+    def __init__(self, oled, chunk_size=0, retries=2, backoff=0.005):
+        self.oled = oled
+        self.chunk_size = int(chunk_size)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.stats = TransferStats()
+
+    def configure(self, chunk_size=None, retries=None, backoff=None):
+        if chunk_size is not None:
+            self.chunk_size = int(chunk_size)
+        if retries is not None:
+            self.retries = int(retries)
+        if backoff is not None:
+            self.backoff = float(backoff)
+
+    # Driver buffer without the leading control byte
+    @property
+    def frame(self):
+        return memoryview(self.oled.buffer)[1:]
+
+    @property
+    def page_addressing(self):
+        return getattr(self.oled, "page_addressing", False)
+
+    # Column/page window setup + data, retried as a whole. Returns the number of bytes written.
+    def write_window(self, c0, c1, p0, p1, data):
+        cmds = bytearray((CMD_CONTROL_BYTE, SET_COL_ADDR, c0, c1, SET_PAGE_ADDR, p0, p1))
+        return self._retry(lambda: self._write(cmds) + self._write_data(data))
+
+    # Command bytes sent as one command stream, retried as a whole
+    def write_commands(self, commands):
+        packet = bytearray([CMD_CONTROL_BYTE])
+        packet.extend(commands)
+        return self._retry(lambda: self._write(packet))
+
+    # Let the driver send the whole buffer (used in page addressing mode)
+    def show(self):
+        self._retry(self.oled.show)
+
+    def _write_data(self, data):
+        data = memoryview(data)
+        step = self.chunk_size if self.chunk_size > 0 else len(data)
+        sent = 0
+        for start in range(0, len(data), step):
+            chunk = data[start:start + step]
+            packet = bytearray(len(chunk) + 1)
+            packet[0] = DATA_CONTROL_BYTE
+            packet[1:] = chunk
+            sent += self._write(packet)
+        return sent
+
+    def _write(self, packet):
+        with self.oled.i2c_device:
+            self.oled.i2c_device.write(packet)
+        self.stats.writes += 1
+        return len(packet)
+
+    def _retry(self, fn):
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except OSError as err:
+                self.stats.errors += 1
+                self.stats.last_error = str(err)
+                if attempt >= self.retries:
+                    self.stats.failures += 1
+                    raise
+                attempt += 1
+                self.stats.retries += 1
+                time.sleep(delay)
+                delay *= 2
@@ -0,0 +1,126 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+
+from .timing import TimingStats
+
+
+##~~ Update queue
+# Sits between OctoPrint's callbacks and the renderer. submit() never blocks on the display: it stores
+# the latest value per key (so a burst of ZChange events for example only renders the last one) and
+# a worker thread hands the pending values to `apply` at most `max_rate` times per second. While paused,
+# updates are only collected and are applied together on resume().
+class UpdateQueue(object):
+    def __init__(self, apply, logger, max_rate=5.0):
+        self._apply = apply
+        self._logger = logger
+        self._cond = threading.Condition()
+        # key -> (value, time the oldest unrendered update for this key was submitted)
+        self._pending = OrderedDict()
+        self._thread = None
+        self._stopping = False
+        self._paused = False
+        self._last_refresh = 0.0
+        self.set_max_rate(max_rate)
+        self.submitted = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.latency = TimingStats()
+        self.apply_time = TimingStats()
+
+    def set_max_rate(self, max_rate):
+        max_rate = float(max_rate)
+        self.max_rate = max_rate
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        with self._cond:
+            self._cond.notify()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def pause(self):
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="OctOLED-updates", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=2.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Queue a new value for `key`, replacing any value that hasn't been rendered yet
+    def submit(self, key, value):
+        now = time.monotonic()
+        with self._cond:
+            self.submitted += 1
+            if key in self._pending:
+                self.coalesced += 1
+                self._pending[key] = (value, self._pending[key][1])
+            else:
+                self._pending[key] = (value, now)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (not self._pending or self._paused) and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                wait = self._last_refresh + self.min_interval - time.monotonic()
+                if wait > 0:
+                    # Rate limited, anything submitted meanwhile gets coalesced
+                    self._cond.wait(wait)
+                    continue
+                pending = self._pending
+                self._pending = OrderedDict()
+
+            start = time.monotonic()
+            self._last_refresh = start
+            try:
+                self._apply(OrderedDict((key, value) for key, (value, submitted) in pending.items()))
+            except Exception as err:
+                self.errors += 1
+                self._logger.error("Display update failed: " + str(err))
+            done = time.monotonic()
+            self.refreshes += 1
+            self.apply_time.add(done - start)
+            for value, submitted in pending.values():
+                self.latency.add(done - submitted)
+
+    def stats(self):
+        return dict(
+            max_rate=self.max_rate,
+            paused=self._paused,
+            depth=self.depth,
+            submitted=self.submitted,
+            coalesced=self.coalesced,
+            refreshes=self.refreshes,
+            errors=self.errors,
+            latency=self.latency.as_dict(),
+            apply=self.apply_time.as_dict()
+        )
@@ -0,0 +1,299 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+from PIL import Image
+
+from .framebuffer import DATA_CONTROL_BYTE, SET_COL_ADDR, SET_PAGE_ADDR, pack_image
+
+##~~ Virtual SSD1306
+# A display that only exists in memory, for running OctOLED without I2C hardware (benchmarks,
+# development on a desktop). VirtualI2C stands in for busio.I2C and charges every transaction the
+# time it would take on a real bus; SSD1306Controller interprets the command/data byte stream the
+# same way the panel does, and VirtualSSD1306 is a drop-in for adafruit_ssd1306.SSD1306_I2C.
+
+# Address byte + 8 bits and an ACK per byte, plus roughly one clock for start and stop conditions
+I2C_BITS_PER_BYTE = 9
+I2C_START_STOP_BITS = 2
+
+# Commands that take parameters -> number of parameter bytes. Everything else is a single byte.
+COMMAND_PARAMS = {
+    0x20: 1,  # memory addressing mode
+    0x21: 2,  # column address
+    0x22: 2,  # page address
+    0x26: 6,  # horizontal scroll setup (right)
+    0x27: 6,  # horizontal scroll setup (left)
+    0x29: 5,  # vertical and right horizontal scroll setup
+    0x2A: 5,  # vertical and left horizontal scroll setup
+    0x81: 1,  # contrast
+    0x8D: 1,  # charge pump
+    0xA3: 2,  # vertical scroll area
+    0xA8: 1,  # multiplex ratio
+    0xD3: 1,  # display offset
+    0xD5: 1,  # clock divide
+    0xD9: 1,  # precharge period
+    0xDA: 1,  # COM pins
+    0xDB: 1,  # VCOMH deselect level
+}
+
+HORIZONTAL_ADDRESSING = 0x00
+PAGE_ADDRESSING = 0x02
+
+
+# The panel side: 128x64 of display RAM plus the registers OctOLED cares about
+class SSD1306Controller(object):
+    def __init__(self):
+        self.ram = bytearray(128 * 8)
+        self.addressing = PAGE_ADDRESSING
+        self.col_window = (0, 127)
+        self.page_window = (0, 7)
+        self.col = 0
+        self.page = 0
+        self.display_on = False
+        self.inverted = False
+        self.contrast = 0x7F
+        self.scrolling = False
+        # RAM writes while a hardware scroll runs, which corrupt real panels
+        self.writes_while_scrolling = 0
+        self.registers = dict()
+        self.commands = 0
+        self.data_bytes = 0
+        self._cmd = []
+
+    # One I2C write: control byte(s) followed by command or data bytes
+    def receive(self, data):
+        pos = 0
+        while pos < len(data):
+            control = data[pos]
+            pos += 1
+            if control & 0x80:
+                # Co=1: a single byte follows, then another control byte
+                if pos < len(data):
+                    self._receive_byte(data[pos], control & 0x40)
+                pos += 1
+            else:
+                for byte in data[pos:]:
+                    self._receive_byte(byte, control & 0x40)
+                return
+
+    def _receive_byte(self, byte, is_data):
+        if is_data:
+            self._write_data(byte)
+        else:
+            self._cmd.append(byte)
+            if len(self._cmd) > COMMAND_PARAMS.get(self._cmd[0], 0):
+                self._command(self._cmd)
+                self._cmd = []
+
+    def _command(self, cmd):
+        self.commands += 1
+        op = cmd[0]
+        if op == 0x20:
+            self.addressing = cmd[1] & 0x03
+        elif op == SET_COL_ADDR:
+            self.col_window = (cmd[1] & 0x7F, cmd[2] & 0x7F)
+            self.col = self.col_window[0]
+        elif op == SET_PAGE_ADDR:
+            self.page_window = (cmd[1] & 0x07, cmd[2] & 0x07)
+            self.page = self.page_window[0]
+        elif op in (0xAE, 0xAF):
+            self.display_on = op == 0xAF
+        elif op in (0xA6, 0xA7):
+            self.inverted = op == 0xA7
+        elif op == 0x81:
+            self.contrast = cmd[1]
+        elif op in (0x2E, 0x2F):
+            self.scrolling = op == 0x2F
+        elif 0xB0 <= op <= 0xB7:
+            self.page = op & 0x07
+        elif op <= 0x0F:
+            self.col = (self.col & 0xF0) | op
+        elif op <= 0x1F:
+            self.col = (self.col & 0x0F) | ((op & 0x0F) << 4)
+        else:
+            self.registers[op] = list(cmd[1:])
+
+    def _write_data(self, byte):
+        self.data_bytes += 1
+        if self.scrolling:
+            self.writes_while_scrolling += 1
+        self.ram[self.page * 128 + self.col] = byte
+        if self.addressing == PAGE_ADDRESSING:
+            self.col = (self.col + 1) & 0x7F
+            return
+        if self.col < self.col_window[1]:
+            self.col += 1
+            return
+        self.col = self.col_window[0]
+        self.page = self.page + 1 if self.page < self.page_window[1] else self.page_window[0]
+
+    # Display RAM of the columns/pages visible on a width x height panel, in the driver's buffer layout
+    def frame(self, width, height):
+        offset = (128 - width) // 2 if width != 128 else 0
+        return b"".join(bytes(self.ram[page * 128 + offset:page * 128 + offset + width]) for page in range(height // 8))
+
+    def to_image(self, width, height):
+        frame = self.frame(width, height)
+        image = Image.new("1", (width, height))
+        pixels = image.load()
+        for page in range(height // 8):
+            for x in range(width):
+                byte = frame[page * width + x]
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        pixels[x, page * 8 + bit] = 255
+        return image
+
+
+# busio.I2C look-alike. Transactions take (bytes * 9 + start/stop) / frequency seconds, slept for real
+# when simulate_timing is set, and are always added to the bus statistics.
+class VirtualI2C(object):
+    def __init__(self, frequency=400000, simulate_timing=True):
+        self.frequency = frequency
+        self.simulate_timing = simulate_timing
+        self.devices = dict()
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time = 0.0
+        self._lock = threading.Lock()
+
+    def attach(self, address, device):
+        self.devices[address] = device
+
+    def scan(self):
+        return sorted(self.devices.keys())
+
+    def try_lock(self):
+        return self._lock.acquire(False)
+
+    def unlock(self):
+        self._lock.release()
+
+    def transfer_time(self, length):
+        return ((length + 1) * I2C_BITS_PER_BYTE + I2C_START_STOP_BITS) / float(self.frequency)
+
+    def writeto(self, address, buffer, start=0, end=None):
+        data = bytes(buffer[start:end])
+        duration = self.transfer_time(len(data))
+        self.transactions += 1
+        self.bytes += len(data) + 1
+        self.bus_time += duration
+        if self.simulate_timing:
+            time.sleep(duration)
+        device = self.devices.get(address)
+        if device is None:
+            # Nobody acknowledged the address
+            raise OSError(121, "Remote I/O error")
+        device.receive(data)
+
+    def stats(self):
+        return dict(
+            frequency=self.frequency,
+            transactions=self.transactions,
+            bytes=self.bytes,
+            bus_ms=self.bus_time * 1000
+        )
+
+
+# adafruit_bus_device.I2CDevice look-alike
+class VirtualI2CDevice(object):
+    def __init__(self, i2c, address):
+        self.i2c = i2c
+        self.device_address = address
+
+    def __enter__(self):
+        while not self.i2c.try_lock():
+            time.sleep(0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.i2c.unlock()
+        return False
+
+    def write(self, buffer, start=0, end=None):
+        self.i2c.writeto(self.device_address, buffer, start=start, end=end)
+
+
+# Same attributes and methods as adafruit_ssd1306.SSD1306_I2C as far as OctOLED uses them. A controller
+# is attached to the bus at `addr` unless there already is a device there.
+class VirtualSSD1306(object):
+    def __init__(self, width, height, i2c, addr=0x3C, page_addressing=False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.addr = addr
+        self.page_addressing = page_addressing
+        self.rotation = 0
+        if addr not in i2c.devices:
+            i2c.attach(addr, SSD1306Controller())
+        self.controller = i2c.devices[addr]
+        self.i2c_device = VirtualI2CDevice(i2c, addr)
+        self.buffer = bytearray(self.pages * width + 1)
+        self.buffer[0] = DATA_CONTROL_BYTE
+        self.init_display()
+
+    def init_display(self):
+        for cmd in (
+            0xAE,                                   # display off
+            0x20, PAGE_ADDRESSING if self.page_addressing else HORIZONTAL_ADDRESSING,
+            0xA8, self.height - 1,                  # multiplex ratio
+            0xDA, 0x02 if self.height == 32 else 0x12,
+            0x81, 0xFF,                             # contrast
+            0x8D, 0x14,                             # charge pump
+            0xAF                                    # display on
+        ):
+            self.write_cmd(cmd)
+        self.fill(0)
+        self.show()
+
+    def write_cmd(self, cmd):
+        with self.i2c_device:
+            self.i2c_device.write(bytes((0x80, cmd)))
+
+    def poweroff(self):
+        self.write_cmd(0xAE)
+
+    def poweron(self):
+        self.write_cmd(0xAF)
+
+    def fill(self, color):
+        value = 0xFF if color else 0x00
+        for i in range(1, len(self.buffer)):
+            self.buffer[i] = value
+
+    # Rotations 0 and 2 pack straight into the buffer, 1 and 3 (portrait, image is height x width)
+    # are turned to landscape first, matching adafruit_framebuf
+    def image(self, image):
+        if self.rotation == 1:
+            image = image.transpose(Image.ROTATE_270)
+        elif self.rotation == 3:
+            image = image.transpose(Image.ROTATE_90)
+        pack_image(image.convert("1"), self.buffer, self.width, self.height, 2 if self.rotation == 2 else 0)
+
+    def show(self):
+        offset = (128 - self.width) // 2 if self.width != 128 else 0
+        if self.page_addressing:
+            for page in range(self.pages):
+                self.write_cmd(0xB0 | page)
+                self.write_cmd(offset & 0x0F)
+                self.write_cmd(0x10 | (offset >> 4))
+                start = 1 + page * self.width
+                packet = bytearray(self.width + 1)
+                packet[0] = DATA_CONTROL_BYTE
+                packet[1:] = self.buffer[start:start + self.width]
+                with self.i2c_device:
+                    self.i2c_device.write(packet)
+            return
+        for cmd in (SET_COL_ADDR, offset, offset + self.width - 1, SET_PAGE_ADDR, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        with self.i2c_device:
+            self.i2c_device.write(self.buffer)
+
+    # What the panel is currently showing
+    def frame(self):
+        return self.controller.frame(self.width, self.height)
+
+    def to_image(self):
+        return self.controller.to_image(self.width, self.height)
@@ -0,0 +1,150 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+
+from PIL import Image, ImageDraw
+
+
+# Placeholder for printer values that haven't been reported yet
+class StatusValues(dict):
+    def __missing__(self, key):
+        return "-"
+
+
+##~~ Widgets
+# A widget owns a rectangle of the display and renders into its own cached 1-bit layer. value() picks
+# what the widget shows out of the printer state; the layer is only re-rendered when that changes.
+class Widget(object):
+    def __init__(self, box, font_size=None, **options):
+        x, y, width, height = [int(v) for v in box]
+        self.box = (x, y, width, height)
+        self.font_size = font_size
+        self.options = options
+        self.layer = Image.new("1", (width, height))
+        self._value = None
+        self._rendered = False
+
+    def value(self, state):
+        raise NotImplementedError
+
+    def render(self, draw, value, atlas):
+        raise NotImplementedError
+
+    # Re-render the layer if the bound value changed, returns True if it did
+    def update(self, state, atlas):
+        value = self.value(state)
+        if self._rendered and value == self._value:
+            return False
+        self._value = value
+        self._rendered = True
+        draw = ImageDraw.Draw(self.layer)
+        draw.rectangle((0, 0, self.box[2], self.box[3]), outline=0, fill=0)
+        self.render(draw, value, atlas)
+        return True
+
+    def _draw_text(self, draw, text, atlas):
+        width, height = atlas.getsize(text)
+        align = self.options.get("align", "left")
+        if align == "center":
+            x = (self.box[2] - width) // 2
+        elif align == "right":
+            x = self.box[2] - width
+        else:
+            x = 0
+        atlas.draw_text(draw, (x, (self.box[3] - height) // 2), text, fill=255)
+
+
+# Formatted printer values, e.g. format="{tool0}/{bed}C"
+class TextWidget(Widget):
+    def value(self, state):
+        try:
+            return self.options.get("format", "").format_map(StatusValues(state))
+        except (ValueError, IndexError):
+            return self.options.get("format", "")
+
+    def render(self, draw, value, atlas):
+        self._draw_text(draw, value, atlas)
+
+
+# Horizontal bar filled to the percentage found under `key` (default "progress")
+class ProgressWidget(Widget):
+    def value(self, state):
+        try:
+            progress = float(state.get(self.options.get("key", "progress"), 0))
+        except ValueError:
+            progress = 0.0
+        # Only re-render when the bar actually grows by a pixel
+        return int(max(0.0, min(100.0, progress)) * (self.box[2] - 2) / 100)
+
+    def render(self, draw, value, atlas):
+        width, height = self.box[2], self.box[3]
+        draw.rectangle((0, 0, width - 1, height - 1), outline=255, fill=0)
+        if value > 0:
+            draw.rectangle((1, 1, value, height - 2), outline=255, fill=255)
+
+
+# Local time from the "time" state value (seconds since the epoch)
+class ClockWidget(Widget):
+    def value(self, state):
+        now = state.get("time")
+        return time.strftime(self.options.get("format", "%H:%M"), time.localtime(now))
+
+    def render(self, draw, value, atlas):
+        self._draw_text(draw, value, atlas)
+
+
+WIDGET_TYPES = {
+    "text": TextWidget,
+    "progress": ProgressWidget,
+    "clock": ClockWidget
+}
+
+
+# Build a widget from its settings entry, e.g. dict(type="text", box=[0, 0, 128, 11], format="{file}")
+def create_widget(config):
+    config = dict(config)
+    widget_type = config.pop("type", "text")
+    if widget_type not in WIDGET_TYPES:
+        raise ValueError("Unknown widget type: " + str(widget_type))
+    return WIDGET_TYPES[widget_type](**config)
+
+
+##~~ Compositor
+# Keeps the widget layers and pastes them into the display image. Only layers that were re-rendered
+# are pasted again, unless something else drew over the image in the meantime (see invalidate()).
+class Compositor(object):
+    # get_atlas(font_size) returns the glyph atlas for a size, None meaning the default display font
+    def __init__(self, widgets, get_atlas):
+        self.widgets = widgets
+        self._get_atlas = get_atlas
+        self._dirty = []
+        self._invalid = True
+        self.renders = 0
+
+    @classmethod
+    def from_settings(cls, configs, get_atlas):
+        return cls([create_widget(config) for config in configs], get_atlas)
+
+    # Everything has to be pasted again on the next compose()
+    def invalidate(self):
+        self._invalid = True
+
+    # Re-render widgets whose values changed, returns True if anything needs to be composed
+    def update(self, state):
+        for widget in self.widgets:
+            if widget.update(state, self._get_atlas(widget.font_size)):
+                self.renders += 1
+                self._dirty.append(widget)
+        return self._invalid or len(self._dirty) > 0
+
+    def compose(self, image):
+        if self._invalid:
+            image.paste(0, (0, 0, image.size[0], image.size[1]))
+            dirty = self.widgets
+        else:
+            dirty = self._dirty
+        for widget in dirty:
+            image.paste(widget.layer, widget.box[:2])
+        self._dirty = []
+        self._invalid = False